@@ -1,14 +1,17 @@
 # classifier_main.py
 
 import argparse
+import os
 import sys
 import time
+import multiprocessing as mp
 from nerdata import *
 from utils import *
 from collections import Counter
 from optimizers import *
 from typing import List
-from featurizers import Featurizer
+from featurizers import Featurizer, person_labels
+from feature_matrix import *
 import random
 random.seed(11)
 np.random.seed(11)
@@ -20,12 +23,18 @@ def _parse_args():
     :return: the parsed args bundle
     """
     parser = argparse.ArgumentParser(description='trainer.py')
-    parser.add_argument('--model', type=str, default='BAD', help='model to run (BAD, CLASSIFIER)')
-    parser.add_argument('--train_path', type=str, default='data/eng.train', help='path to train set (you should not need to modify)')
+    parser.add_argument('--model', type=str, default='BAD', help='model to run (BAD, CLASSIFIER, MULTITYPE)')
+    parser.add_argument('--train_path', type=str, default='data/eng.train', help='path to train set, a CoNLL file or a directory converted by nerdata.py (you should not need to modify)')
     parser.add_argument('--dev_path', type=str, default='data/eng.testa', help='path to dev set (you should not need to modify)')
     parser.add_argument('--blind_test_path', type=str, default='data/eng.testb.blind', help='path to dev set (you should not need to modify)')
     parser.add_argument('--test_output_path', type=str, default='eng.testb.out', help='output path for test predictions')
     parser.add_argument('--no_run_on_test', dest='run_on_test', default=True, action='store_false', help='skip printing output on the test set')
+    parser.add_argument('--hash_dimensions', type=int, default=None, help='hash the word and pos indicator features and the word count tables into this many dimensions instead of indexing the vocabulary')
+    parser.add_argument('--trainer', type=str, default='adagrad', help='optimizer used to train CLASSIFIER (adagrad, ftrl, lbfgs, hogwild); lbfgs minimizes the full-batch objective to convergence, which takes a few hundred passes over the data against 13 for adagrad, for a slightly lower F1')
+    parser.add_argument('--num_workers', type=int, default=4, help='number of processes used by the hogwild trainer')
+    parser.add_argument('--save_model', type=str, default=None, help='directory to save the trained CLASSIFIER or MULTITYPE model to')
+    parser.add_argument('--load_model', type=str, default=None, help='directory of a saved CLASSIFIER or MULTITYPE model to tag with instead of training one')
+    parser.add_argument('--benchmark_hogwild', dest='benchmark_hogwild', default=False, action='store_true', help='time the hogwild trainer with 1, 2, 4 and 8 workers against the serial trainer before training')
     args = parser.parse_args()
     return args
 
@@ -37,25 +46,38 @@ class PersonExample(object):
     Attributes:
         tokens: the sentence to classify
         labels: 0 if non-person name, 1 if person name for each token in the sentence
+        type_labels: optional [num_tokens, num_types] 0/1 array, whether each token belongs to each entity type
     """
-    def __init__(self, tokens: List[str], pos_tags: List[str], labels: List[int]):
+    def __init__(self, tokens: List[str], pos_tags: List[str], labels: List[int], type_labels=None):
         self.tokens = tokens
         self.pos_tags = pos_tags
         self.labels = labels
+        self.type_labels = type_labels
 
     def __len__(self):
         return len(self.tokens)
 
 
-def transform_for_classification(ner_exs: List[LabeledSentence]):
+ENTITY_TYPES = ['PER', 'ORG', 'LOC', 'MISC']
+
+def transform_for_classification(ner_exs: List[LabeledSentence], entity_types=None):
     """
     :param ner_exs: List of chunk-style NER examples
+    :param entity_types: if given, the examples also carry their type_labels for these entity types
     :return: A list of PersonExamples extracted from the NER data
     """
+    type_columns = {entity_type: column for column, entity_type in enumerate(entity_types or [])}
     for labeled_sent in ner_exs:
         tags = bio_tags_from_chunks(labeled_sent.chunks, len(labeled_sent))
         labels = [1 if tag.endswith("PER") else 0 for tag in tags]
-        yield PersonExample([tok.word for tok in labeled_sent.tokens], [tok.pos for tok in labeled_sent.tokens], labels)
+        type_labels = None
+        if entity_types is not None:
+            type_labels = np.zeros((len(tags), len(entity_types)), dtype=int)
+            for idx, tag in enumerate(tags):
+                if tag[2:] in type_columns:
+                    type_labels[idx, type_columns[tag[2:]]] = 1
+        yield PersonExample([tok.word for tok in labeled_sent.tokens], [tok.pos for tok in labeled_sent.tokens], labels,
+                            type_labels)
 
 
 class CountBasedPersonClassifier(object):
@@ -77,6 +99,13 @@ class CountBasedPersonClassifier(object):
         else:
             return 0
 
+    def predict_batch(self, exs: List[PersonExample]):
+        """
+        :param exs: PersonExamples to classify
+        :return: a list with one list of {0, 1} predictions per example
+        """
+        return [[self.predict(ex.tokens, idx) for idx in range(0, len(ex))] for ex in exs]
+
 
 def train_count_based_binary_classifier(ner_exs: List[PersonExample]):
     """
@@ -114,11 +143,57 @@ class PersonClassifier(object):
     """
     Classifier to classify a token in a sentence as a PERSON token or not.
     Constructor arguments are merely suggestions; you're free to change these.
+
+    Attributes:
+        W: weight vector over the expanded feature space (featurizer.num_dimensions)
+        featurizer: Featurizer used to build the compressed features of a sentence
+        threshold: tokens whose sigmoid score is above this value are classified as persons
     """
 
-    def __init__(self, weights: np.ndarray, featurizer: Featurizer):
+    def __init__(self, weights: np.ndarray, featurizer: Featurizer, threshold=0.55):
         self.W = weights
         self.featurizer = featurizer
+        self.threshold = threshold
+
+    def score(self, X: np.ndarray):
+        """
+        Scores compressed features without expanding them to their one hot form
+        :param X: [num_tokens, 22] compressed features as returned by the featurizer (a single row is also accepted)
+        :return: [num_tokens] array of sigmoid scores
+        """
+        direct, indicators, active = compress_features(np.atleast_2d(X), self.featurizer.num_direct_dimensions)
+        z = np.matmul(direct, self.W[0:direct.shape[1]]) + np.sum(self.W[indicators] * active, axis=1)
+        return sigmoid(z)
+
+    def save(self, path: str):
+        """
+        Writes the weights and the featurizer tables to the directory path, one .npy file per array, so that load
+        can memory map them instead of rereading and retraining on the training set
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = self.featurizer.to_arrays()
+        arrays['weights'] = np.asarray(self.W, dtype=float)
+        arrays['threshold'] = np.array([self.threshold])
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a classifier written by save; the arrays are memory mapped read only, and the weights, words and counts
+        are used from the mapped files without being copied (see Featurizer.from_arrays)
+        :return: an EntityTypeClassifier if path holds the entity types of one, a PersonClassifier otherwise
+        """
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in ('words', 'word_indices', 'word_counts', 'pos_tags', 'prior_types', 'corpus', 'weights',
+                               'threshold')}
+        featurizer = Featurizer.from_arrays(arrays)
+        threshold = float(arrays['threshold'][0])
+        entity_types_path = os.path.join(path, 'entity_types.npy')
+        if os.path.exists(entity_types_path):
+            entity_types = decode_strings(np.load(entity_types_path))
+            return EntityTypeClassifier(arrays['weights'], featurizer, entity_types, threshold)
+        return PersonClassifier(arrays['weights'], featurizer, threshold)
 
     def predict(self, tokens: List[str], pos_tags: List[str], idx: int):
         """
@@ -128,158 +203,435 @@ class PersonClassifier(object):
         :return: 0 if not a person token, 1 if a person token
         """
         feature = self.featurizer.featurize_oneInstance(tokens, pos_tags, idx)
-        X = expand_features(np.array(feature), self.featurizer.num_dimensions,\
-             self.featurizer.num_direct_dimensions)               
-        z = np.matmul(X, self.W)
-        y_pred = sigmoid(z)
+        y_pred = self.score(feature)[0]
 
-        if(y_pred > 0.55):
+        if(y_pred > self.threshold):
             return 1
         
         return 0
-    # def predict(self, tokens, idx):
-        # raise Exception("Implement me!")
 
-def shuffle_together(a, b):
+    def predict_sentence(self, tokens: List[str], pos_tags: List[str]):
+        """
+        Makes a prediction for every token of a sentence with one matrix operation
+        :param tokens:
+        :param pos_tags:
+        :return: list of 0/1 predictions, one per token
+        """
+        X = self.featurizer.featurize(tokens, pos_tags)
+        return (self.score(X) > self.threshold).astype(int).tolist()
+
+    def predict_batch(self, exs: List[PersonExample]):
+        """
+        Makes predictions for all the tokens of all the given examples, scored together as one matrix operation
+        :param exs: PersonExamples to classify
+        :return: a list with one list of 0/1 predictions per example
+        """
+        exs = list(exs)
+        if len(exs) == 0:
+            return []
+        X = self.featurizer.featurize_corpus([ex.tokens for ex in exs], [ex.pos_tags for ex in exs])
+        predictions = (self.score(X) > self.threshold).astype(int)
+        boundaries = np.cumsum([len(ex) for ex in exs])[:-1]
+        return [sentence_predictions.tolist() for sentence_predictions in np.split(predictions, boundaries)]
+
+class EntityTypeClassifier(PersonClassifier):
     """
-    used to shuffle to np arrays together,
-    such as the features and their corresponding labels
+    One-vs-rest classifier over several entity types, scoring all of them with one product against a weight matrix.
+    The tokens are featurized once for all the types by a Featurizer given the entity types, which adds the name
+    prior features (counts of a word as, or next to, a token of the type) of every type other than PER to the
+    person ones, so every column of W can weigh the priors of its own type.
+
+    Attributes:
+        W: [featurizer.num_dimensions, num_types] weight matrix, one column per entity type
+        entity_types: name of the type of every column of W
+        threshold: tokens whose sigmoid score for a type is above this value are classified as that type
     """
-    assert len(a) == len(b)
-    p = np.random.permutation(len(a))
-    return a[p], b[p]
 
-def expand_features(X, num_dimensions, num_direct_dimensions):
+    def __init__(self, weights: np.ndarray, featurizer: Featurizer, entity_types: List[str], threshold=0.55):
+        super().__init__(weights, featurizer, threshold)
+        self.entity_types = entity_types
+
+    def save(self, path: str):
+        """
+        Writes the classifier as PersonClassifier.save does, plus its entity types, from which load knows to
+        rebuild an EntityTypeClassifier
+        """
+        super().save(path)
+        np.save(os.path.join(path, 'entity_types.npy'), encode_strings(self.entity_types))
+
+    def score(self, X: np.ndarray):
+        """
+        :param X: [num_tokens, 22] compressed features as returned by the featurizer
+        :return: [num_tokens, num_types] array of sigmoid scores
+        """
+        direct, indicators, active = compress_features(np.atleast_2d(X), self.featurizer.num_direct_dimensions)
+        z = np.matmul(direct, self.W[0:direct.shape[1]]) + np.sum(self.W[indicators] * active[:, :, np.newaxis], axis=1)
+        return sigmoid(z)
+
+    def labels(self, scores: np.ndarray):
+        """
+        :param scores: [num_tokens, num_types] sigmoid scores
+        :return: [num_tokens] array of the type with the highest score for the tokens above the threshold for some
+        type, O for the others
+        """
+        return np.where(scores.max(axis=1) > self.threshold, np.array(self.entity_types)[scores.argmax(axis=1)], 'O')
+
+    def predict(self, tokens: List[str], pos_tags: List[str], idx: int):
+        """
+        Makes a prediction for token at position idx
+        :return: the entity type of the token, or O
+        """
+        return str(self.labels(self.score(self.featurizer.featurize_oneInstance(tokens, pos_tags, idx)))[0])
+
+    def predict_sentence(self, tokens: List[str], pos_tags: List[str]):
+        """
+        Makes a prediction for every token of a sentence with one matrix operation
+        :return: list of labels, one per token, as predict
+        """
+        return self.labels(self.score(self.featurizer.featurize(tokens, pos_tags))).tolist()
+
+    def predict_types(self, exs: List[PersonExample]):
+        """
+        :return: [total number of tokens, num_types] 0/1 array of the one-vs-rest decisions for every token of exs
+        """
+        X = self.featurizer.featurize_corpus([ex.tokens for ex in exs], [ex.pos_tags for ex in exs])
+        return (self.score(X) > self.threshold).astype(int)
+
+    def predict_batch(self, exs: List[PersonExample]):
+        """
+        :return: a list with one list of labels per example: the type with the highest score for the tokens
+        above the threshold for some type, O for the others
+        """
+        exs = list(exs)
+        if len(exs) == 0:
+            return []
+        scores = self.score(self.featurizer.featurize_corpus([ex.tokens for ex in exs], [ex.pos_tags for ex in exs]))
+        labels = self.labels(scores)
+        boundaries = np.cumsum([len(ex) for ex in exs])[:-1]
+        return [sentence_labels.tolist() for sentence_labels in np.split(labels, boundaries)]
+
+def featurize_examples(featurizer: Featurizer, exs: List[PersonExample]):
     """
-    the higher dimensional features (indicator and pos features) are uncompressed
-    to their one hot form in this function
+    featurizes all the tokens of the given examples
+    :param exs: PersonExamples, or a CorpusStore to featurize directly from its id arrays
+    :return: compressed features [num_tokens, 22] and the labels [num_tokens]
     """
+    if isinstance(exs, CorpusStore):
+        return featurizer.featurize_store(exs), person_labels(exs)
+    exs = list(exs)
+    all_X = featurizer.featurize_corpus([ex.tokens for ex in exs], [ex.pos_tags for ex in exs])
+    all_Y = np.array([label for ex in exs for label in ex.labels], dtype=int)
+    return all_X, all_Y
 
-    should_squeeze = False
-    if(len(X.shape) == 1):
-        X = np.expand_dims(X, axis=0)
-        should_squeeze = True
-    new_X = np.zeros((len(X), num_dimensions))
-    new_X[:, 0:num_direct_dimensions] = X[:, 0:num_direct_dimensions]
 
-    for i in range(len(new_X)): # 3 pos tags and 3 indicataor features
-        new_X[i, X[i,-6].astype(int)] = 1
-        new_X[i, X[i,-5].astype(int)] = 1
-        new_X[i, X[i,-4].astype(int)] = 1
-        new_X[i, X[i,-3].astype(int)] = 1
-        new_X[i, X[i,-2].astype(int)] = 1
-        new_X[i, X[i,-1].astype(int)] = 1
+def run_minibatches(matrix: FeatureMatrix, Y: np.ndarray, optimizer: Optimizer, order: np.ndarray,
+                    scale_toBalance=4.0, batch_size=1024):
+    """
+    one pass of minibatch updates over the given rows: sigmoid, loss and gradient are computed for a
+    whole batch at once and the gradient is scattered only into the columns active in the batch
+    :param order: indices of the rows of matrix to visit, in that order
+    :return: the summed loss of the visited rows
+    """
+    W = optimizer.weights
+    if Y.ndim == 2:
+        #one column of labels per output: the optimizer holds the flattened [num_dimensions, num_outputs] weights
+        W = W.reshape(-1, Y.shape[1])
+    sample_weights = np.where(Y == 1, scale_toBalance, 1.0)
+    total_loss = 0.0
+
+    for cursor in range(0, len(order), batch_size):
+        rows = order[cursor: cursor+batch_size]
+        X = matrix.take(rows)
+        y = Y[rows]
+        y_pred = sigmoid(X.dot(W))
+        total_loss += logistic_loss(y, y_pred, scale_toBalance)
+
+        # gradient of the weighted log likelihood, with the same x10 step scaling as the per-token trainer.
+        # It is summed rather than averaged over the batch: the 1 + sqrt(G) denominator of Adagrad is not
+        # scale invariant, so averaged gradients would make the steps of rare features vanish
+        indices, values = X.transpose_dot((y - y_pred) * sample_weights[rows] * 10)
+        if Y.ndim == 2:
+            indices = (indices[:, np.newaxis] * Y.shape[1] + np.arange(Y.shape[1])).ravel()
+        optimizer.apply_gradient_update((indices, values.ravel()), 1)
+
+    return total_loss
+
+
+def train_minibatch(matrix: FeatureMatrix, Y: np.ndarray, optimizer: Optimizer, num_epochs: int,
+                    scale_toBalance=4.0, batch_size=1024):
+    """
+    trains a logistic model over a sparse feature matrix with shuffled minibatches
+    :param matrix: FeatureMatrix of the training tokens
+    :param Y: 0/1 labels of the rows of matrix
+    :param optimizer: optimizer wrapping the weight vector, updated in place
+    :param scale_toBalance: additional weight given to the person class
+    :param batch_size: number of tokens per update
+    """
+    for epoch in range(num_epochs):
+        order = np.random.permutation(len(matrix))
+        total_loss = run_minibatches(matrix, Y, optimizer, order, scale_toBalance, batch_size)
+        print('Loss at epoch {} : {}'.format(epoch, total_loss/len(order)))
 
-    if(should_squeeze):
-        new_X = np.squeeze(new_X)
-    return new_X
+    return optimizer.get_final_weights()
 
-def get_gradient_keys(X, num_direct_dimensions):
+
+# state of a hogwild worker process, set once by _init_hogwild_worker
+_hogwild_state = {}
+
+def _shared_array(array: np.ndarray, typecode: str):
     """
-    return the list of  non zero indices of X, so that the 
-    corresponding gradients can be updated
+    copies array into an unsynchronized shared memory buffer that worker processes can write to
+    :return: the RawArray and a numpy view on it
     """
+    shared = mp.RawArray(typecode, len(array))
+    view = np.frombuffer(shared, dtype=array.dtype)
+    view[:] = array
+    return shared, view
 
-    gradient_key_list = []
-    for x in X:
-        gradient_keys = []
-        for i in range(num_direct_dimensions):
-            if(x[i] != 0.0):
-                gradient_keys.append(i)
+def share_training_data(matrix: FeatureMatrix, Y: np.ndarray):
+    """
+    copies a feature matrix and its labels into shared memory, once, for the initializer of a process pool
+    :return: the arguments of attach_training_data
+    """
+    return [_shared_array(np.asarray(array, dtype=dtype), code)[0] for array, dtype, code in
+            ((matrix.indptr, np.int64, 'q'), (matrix.indices, np.int64, 'q'), (matrix.data, float, 'd'),
+             (matrix.gradient_data, float, 'd'), (Y, np.int64, 'q'))] + [matrix.num_dimensions]
 
-        for i in range(num_direct_dimensions, X.shape[1]):
-            gradient_keys.append(int(x[i]))
-        # gradient_keys.append(int(x[-2]))
-        # gradient_keys.append(int(x[-1]))
+def attach_training_data(indptr, indices, data, gradient_data, Y, num_dimensions):
+    """
+    inverse of share_training_data, called in a worker process
+    :return: the FeatureMatrix and labels as read only views on the shared memory
+    """
+    arrays = [np.frombuffer(indptr, dtype=np.int64), np.frombuffer(indices, dtype=np.int64), np.frombuffer(data, dtype=float),
+              np.frombuffer(gradient_data, dtype=float), np.frombuffer(Y, dtype=np.int64)]
+    for array in arrays:
+        array.flags.writeable = False
+    return FeatureMatrix(arrays[0], arrays[1], arrays[2], num_dimensions, arrays[3]), arrays[4]
 
-        gradient_key_list.append(gradient_keys)
-    
-    return gradient_key_list
+def _init_hogwild_worker(W, diag_Gt, *training_data):
+    """
+    rebuilds, in a worker process, the views on the shared weights, Adagrad accumulators and training data
+    """
+    optimizer = UnregularizedAdagradTrainer(np.frombuffer(W, dtype=float))
+    optimizer.diag_Gt = np.frombuffer(diag_Gt, dtype=float)
+    _hogwild_state['optimizer'] = optimizer
+    _hogwild_state['matrix'], _hogwild_state['Y'] = attach_training_data(*training_data)
+
+def _hogwild_shard(order: np.ndarray, scale_toBalance: float, batch_size: int):
+    """
+    runs the minibatch updates of one shard of an epoch directly on the shared weights
+    """
+    return run_minibatches(_hogwild_state['matrix'], _hogwild_state['Y'], _hogwild_state['optimizer'], order,
+                           scale_toBalance, batch_size)
+
+def train_hogwild(matrix: FeatureMatrix, Y: np.ndarray, W: np.ndarray, num_epochs: int, scale_toBalance=4.0,
+                  batch_size=1024, num_workers=4):
+    """
+    Hogwild! training with the unregularized Adagrad trainer: the weights and the Adagrad accumulators live in shared
+    memory, every epoch the shuffled tokens are split into num_workers disjoint shards and each worker process applies
+    its sparse updates without any locking. Indicator features are rare, so concurrent updates seldom touch the same
+    weights and the lost updates barely matter.
+    See https://arxiv.org/abs/1106.5730 for more details
+    :param W: initial weight vector, it is not modified
+    :param num_workers: number of worker processes
+    :return: the trained weight vector
+    """
+    shared_W, W_view = _shared_array(W, 'd')
+    shared_Gt, _ = _shared_array(np.zeros_like(W, dtype=float), 'd')
+
+    with mp.Pool(num_workers, initializer=_init_hogwild_worker,
+                 initargs=[shared_W, shared_Gt] + share_training_data(matrix, Y)) as pool:
+        for epoch in range(num_epochs):
+            order = np.random.permutation(len(matrix))
+            shards = np.array_split(order, num_workers)
+            total_loss = sum(pool.starmap(_hogwild_shard, [(shard, scale_toBalance, batch_size) for shard in shards]))
+            print('Loss at epoch {} : {}'.format(epoch, total_loss/len(order)))
+
+    return W_view.copy()
+
+
+def benchmark_hogwild(matrix: FeatureMatrix, Y: np.ndarray, W: np.ndarray, num_epochs: int, scale_toBalance=4.0,
+                      batch_size=1024, worker_counts=(1, 2, 4, 8)):
+    """
+    Times the serial minibatch trainer and train_hogwild with every number of workers from the same initial weights,
+    and prints the speedup of each against the serial path. The global random state is restored afterwards, so that
+    the model trained after the benchmark is the same as without it
+    """
+    random_state = np.random.get_state()
+    try:
+        start_time = time.time()
+        train_minibatch(matrix, Y, UnregularizedAdagradTrainer(W.copy()), num_epochs, scale_toBalance, batch_size)
+        serial_time = time.time() - start_time
+
+        timings = []
+        for num_workers in worker_counts:
+            start_time = time.time()
+            train_hogwild(matrix, Y, W, num_epochs, scale_toBalance, batch_size, num_workers)
+            timings.append(time.time() - start_time)
+    finally:
+        np.random.set_state(random_state)
+
+    print('serial: {:.2f} seconds'.format(serial_time))
+    for num_workers, elapsed in zip(worker_counts, timings):
+        print('hogwild with {} workers: {:.2f} seconds, speedup {:.2f}x'.format(num_workers, elapsed, serial_time/elapsed))
+
+
+def rescale_weights(W: np.ndarray):
+    """
+    slightly increases the weight given to indicator and pos features, a simple trick to avoid overfitting, applied
+    to the weights trained by adagrad before they are used
+    :return: W, rescaled in place
+    """
+    W[15:] *= 1.2
+    return W
+
+
+def weighted_logistic_objective(matrix: FeatureMatrix, Y: np.ndarray, scale_toBalance=4.0, l2=0.1):
+    """
+    full-batch objective for lbfgs_minimize: the class weighted logistic loss of the whole corpus (the same
+    weighting as logistic_loss) plus an L2 penalty on every weight but the bias, with its exact gradient computed
+    by sparse products
+    :return: function mapping W to (loss, gradient)
+    """
+    sample_weights = np.where(Y == 1, scale_toBalance, 1.0)
+    penalties = np.full(matrix.num_dimensions, l2)
+    penalties[15] = 0.0 # bias
+
+    def objective(W):
+        z = matrix.dot(W)
+        # -log(sigmoid(z)) and -log(1 - sigmoid(z)) computed without overflow
+        losses = np.where(Y == 1, np.logaddexp(0, -z), np.logaddexp(0, z))
+        loss = np.sum(sample_weights * losses) + 0.5 * W.dot(penalties * W)
+        y_pred = np.exp(-np.logaddexp(0, -z))
+        gradient = matrix.rmatvec(sample_weights * (y_pred - Y)) + penalties * W
+        return loss, gradient
+
+    return objective
+
+
+def lbfgs_scales(matrix: FeatureMatrix, Y: np.ndarray, scale_toBalance=4.0, l2=0.1):
+    """
+    per weight scales for lbfgs_minimize: the -1/4 power of the bound on the diagonal of the Hessian of
+    weighted_logistic_objective (the curvature of the logistic loss is at most 1/4). Halfway between no scaling and
+    the Jacobi (-1/2 power) one, it reached the optimum on eng.train in about three times fewer passes than either
+    """
+    sample_weights = np.where(Y == 1, scale_toBalance, 1.0)
+    curvatures = 0.25 * np.bincount(matrix.indices, weights=matrix.data ** 2 * sample_weights[matrix.row_ids],
+                                    minlength=matrix.num_dimensions) + l2
+    return np.maximum(curvatures, 1e-12) ** -0.25
 
 
-def train_classifier(ner_exs: List[PersonExample]):
+def train_classifier(ner_exs: List[PersonExample], hash_dimensions=None, trainer='adagrad', num_workers=4,
+                     benchmark=False, l2=0.1):
     """
     the training functions which return a predictor instance
     initialized with the trained weights
+    :param ner_exs: training examples, or a CorpusStore of the training set
+    :param hash_dimensions: size of the hashed indicator space and count tables, None to index the vocabulary
+    :param trainer: adagrad, ftrl for a sparse weight vector, lbfgs for full-batch quasi-Newton training (converged,
+    but in far more passes than adagrad) or hogwild for adagrad run by num_workers lock-free processes
+    :param benchmark: first report the speedup of the hogwild trainer against the serial adagrad trainer
+    :param l2: L2 penalty of the objective minimized by the lbfgs trainer
     """
 
-    featurizer = Featurizer(ner_exs)
-    W = np.random.rand(featurizer.num_dimensions)
-    optimizer1 = UnregularizedAdagradTrainer(W)
+    featurizer = Featurizer(ner_exs, hash_dimensions=hash_dimensions)
+    if trainer == 'adagrad':
+        W = np.random.rand(featurizer.num_dimensions)
+        optimizer1 = UnregularizedAdagradTrainer(W)
+    elif trainer == 'hogwild':
+        W = np.random.rand(featurizer.num_dimensions) # train_hogwild keeps its own shared Adagrad accumulators
+    elif trainer == 'ftrl':
+        W = np.zeros(featurizer.num_dimensions)
+        optimizer1 = FTRLProximalOptimizer(W, alpha=1.0, beta=1.0, l1=5.0, l2=1.0)
+    elif trainer == 'lbfgs':
+        W = np.zeros(featurizer.num_dimensions)
+    else:
+        raise Exception("Unknown trainer: %s" % trainer)
 
     num_epochs = 13
-    swap_epoch = 100
     scale_toBalance = 4.0
-    batch_size = 1
-    regularization = False
-    all_X = []
-    all_Y = []
+    batch_size = 256
 
     #gathering all train examples
-    for ex in train_class_exs:
-        features = featurizer.featurize(ex.tokens, ex.pos_tags)
-        X = np.array(features)
-        Y = np.array(ex.labels)
-        all_X.append(X)
-        all_Y.append(Y)
-    
-    all_X = np.concatenate(all_X)
-    all_Y = np.concatenate(all_Y)
+    all_X, all_Y = featurize_examples(featurizer, ner_exs)
+    matrix = FeatureMatrix.from_compressed(all_X, featurizer.num_dimensions, featurizer.num_direct_dimensions)
 
-    for epoch in range(num_epochs):
-        total_loss = 0.0
-        total_count = 0.0
-            
-
-        all_X, all_Y = shuffle_together(all_X, all_Y)
-        cursor = 0
-
-        while cursor + batch_size < len(all_X):
-            
-            X = expand_features(all_X[cursor: cursor+batch_size, :], featurizer.num_dimensions,\
-            featurizer.num_direct_dimensions)
-            gradient_key_list = get_gradient_keys(all_X[cursor: cursor+batch_size, :], featurizer.num_direct_dimensions)
-            y = all_Y[cursor: cursor+batch_size]
-            z = np.matmul(X, W)
-            y_pred = sigmoid(z)
-            loss = logistic_loss(y, y_pred, scale_toBalance)
-            gradient = y - y_pred
-            
-            gradient_counter = Counter()
-            for i in range(len(gradient_key_list)):        
-                if(y[i]==0):
-                    scale_factor = 1.0
-                else:
-                    scale_factor = scale_toBalance       
-                for key in gradient_key_list[i]:
-                    if not regularization or key > featurizer.num_direct_dimensions:
-                        gradient_counter[key] += gradient[i] * X[i, key] *scale_factor *10
-
-            optimizer1.apply_gradient_update(gradient_counter, batch_size)
-
-            cursor += batch_size
-            total_loss += np.sum(loss)
-            total_count += batch_size
-        
-        # np.save('dense_SGD_weights_final_18_{}.npy'.format(epoch), W)
-        print('Loss at epoch {} : {}'.format(epoch, total_loss/total_count))
+    if benchmark:
+        benchmark_hogwild(matrix, all_Y, W, num_epochs, scale_toBalance, batch_size)
+
+    start_time = time.time()
+    if trainer == 'lbfgs':
+        W, num_passes, stop_reason = lbfgs_minimize(weighted_logistic_objective(matrix, all_Y, scale_toBalance, l2), W,
+                                                    max_iters=1000, tolerance=1e-5,
+                                                    scales=lbfgs_scales(matrix, all_Y, scale_toBalance, l2))
+        print('lbfgs stopped: {}'.format(stop_reason))
+    elif trainer == 'hogwild':
+        W = train_hogwild(matrix, all_Y, W, num_epochs, scale_toBalance, batch_size, num_workers)
+        num_passes = num_epochs
+    else:
+        W = train_minibatch(matrix, all_Y, optimizer1, num_epochs, scale_toBalance, batch_size)
+        num_passes = num_epochs
+    print('{} training took {} seconds, {} passes over the data'.format(trainer, time.time() - start_time, num_passes))
+    print('nonzero weights: {} / {}'.format(np.count_nonzero(W), len(W)))
     
-    W[15:] *= 1.2 # slightly increasing the weight given to indicator and pos features, a simple trick to avoid overfitting
+    if trainer != 'lbfgs':
+        rescale_weights(W)
 
     return PersonClassifier(W, featurizer)
 
+def train_entity_type_classifier(ner_exs: List[PersonExample], entity_types: List[str], hash_dimensions=None):
+    """
+    one-vs-rest counterpart of train_classifier: the logistic models of all the entity types are trained together
+    with adagrad, over one feature matrix, as the columns of a [num_dimensions, num_types] weight matrix. Every
+    token is featurized once with the name priors of all the types (see EntityTypeClassifier)
+    :param ner_exs: examples with type_labels for entity_types
+    """
+
+    featurizer = Featurizer(ner_exs, hash_dimensions=hash_dimensions, entity_types=entity_types)
+    W = np.random.rand(featurizer.num_dimensions, len(entity_types))
+    optimizer1 = UnregularizedAdagradTrainer(W.reshape(-1))
+
+    num_epochs = 13
+    scale_toBalance = 4.0
+    batch_size = 256
+
+    all_X, _ = featurize_examples(featurizer, ner_exs)
+    all_Y = np.concatenate([ex.type_labels for ex in ner_exs])
+    matrix = FeatureMatrix.from_compressed(all_X, featurizer.num_dimensions, featurizer.num_direct_dimensions)
+
+    start_time = time.time()
+    train_minibatch(matrix, all_Y, optimizer1, num_epochs, scale_toBalance, batch_size)
+    print('training {} types took {} seconds'.format(len(entity_types), time.time() - start_time))
+
+    rescale_weights(W)
+
+    return EntityTypeClassifier(W, featurizer, entity_types)
+
+def evaluate_entity_type_classifier(exs: List[PersonExample], classifier: EntityTypeClassifier):
+    """
+    Prints the evaluation of every entity type of the classifier on the given examples
+    :param exs: PersonExample instances with type_labels
+    """
+    exs = list(exs)
+    golds = np.concatenate([ex.type_labels for ex in exs])
+    predictions = classifier.predict_types(exs)
+    for column, entity_type in enumerate(classifier.entity_types):
+        print("---%s---" % entity_type)
+        print_evaluation(golds[:, column].tolist(), predictions[:, column].tolist())
+
 def evaluate_classifier(exs: List[PersonExample], classifier: PersonClassifier):
     """
     Prints evaluation of the classifier on the given examples
-    :param exs: PersonExample instances to run on
+    :param exs: PersonExample instances to run on, or a CorpusStore
     :param classifier: classifier to evaluate
     """
-    predictions = []
-    golds = []
-    for ex in exs:
-        for idx in range(0, len(ex)):
-            golds.append(ex.labels[idx])
-            predictions.append(classifier.predict(ex.tokens, ex.pos_tags, idx))
+    if isinstance(exs, CorpusStore):
+        predictions = classifier.score(classifier.featurizer.featurize_store(exs)) > classifier.threshold
+        print_evaluation(person_labels(exs).tolist(), predictions.astype(int).tolist())
+        return
+    exs = list(exs)
+    golds = [label for ex in exs for label in ex.labels]
+    predictions = [prediction for sentence_predictions in classifier.predict_batch(exs) for prediction in sentence_predictions]
     print_evaluation(golds, predictions)
 
 
@@ -327,10 +679,9 @@ def predict_write_output_to_file(exs: List[PersonExample], classifier: PersonCla
     :return:
     """
     f = open(outfile, 'w')
-    for ex in exs:
-        for idx in range(0, len(ex)):
-            prediction = classifier.predict(ex.tokens, ex.pos_tags,  idx)
-            f.write(ex.tokens[idx] + " " + repr(int(prediction)) + "\n")
+    for ex, predictions in zip(exs, classifier.predict_batch(exs)):
+        for idx, prediction in enumerate(predictions):
+            f.write(ex.tokens[idx] + " " + str(prediction) + "\n")
         f.write("\n")
     f.close()
 
@@ -340,22 +691,44 @@ if __name__ == '__main__':
     print(args)
     # Load the training and test data
 
-    train_class_exs = list(transform_for_classification(read_data(args.train_path)))
-    dev_class_exs = list(transform_for_classification(read_data(args.dev_path)))
+    if args.save_model is not None and args.load_model is None and args.model == "BAD":
+        raise Exception("--save_model is not supported for the BAD model")
+    if args.load_model is not None:
+        classifier = PersonClassifier.load(args.load_model)
+        print("Loaded model from %s" % args.load_model)
+        entity_types = classifier.entity_types if isinstance(classifier, EntityTypeClassifier) else None
+    else:
+        entity_types = ENTITY_TYPES if args.model == "MULTITYPE" else None
+    train_class_exs = None
+    if args.load_model is None and args.model == "CLASSIFIER" and os.path.isdir(args.train_path):
+        #a CorpusStore written by nerdata.py is trained on directly from its id arrays
+        train_class_exs = CorpusStore.load(args.train_path)
+    elif args.load_model is None:
+        train_class_exs = list(transform_for_classification(read_data(args.train_path), entity_types))
+    dev_class_exs = list(transform_for_classification(read_data(args.dev_path), entity_types))
 
     
     # Train the model
-    if args.model == "BAD":
-        classifier = train_count_based_binary_classifier(train_class_exs)
-    else:
-        classifier = train_classifier(train_class_exs)
+    if args.load_model is None:
+        if args.model == "BAD":
+            classifier = train_count_based_binary_classifier(train_class_exs)
+        elif args.model == "MULTITYPE":
+            classifier = train_entity_type_classifier(train_class_exs, entity_types, args.hash_dimensions)
+        else:
+            classifier = train_classifier(train_class_exs, args.hash_dimensions, args.trainer, args.num_workers,
+                                          args.benchmark_hogwild)
+        if args.save_model is not None:
+            classifier.save(args.save_model)
+            print("Saved model to %s" % args.save_model)
 
     print("Data reading and training took %f seconds" % (time.time() - start_time))
     # Evaluate on training, development, and test data
-    print("===Train accuracy===")
-    evaluate_classifier(train_class_exs, classifier)
+    evaluate = evaluate_entity_type_classifier if isinstance(classifier, EntityTypeClassifier) else evaluate_classifier
+    if train_class_exs is not None:
+        print("===Train accuracy===")
+        evaluate(train_class_exs, classifier)
     print("===Dev accuracy===")
-    evaluate_classifier(dev_class_exs, classifier)
+    evaluate(dev_class_exs, classifier)
     if args.run_on_test:
         print("Running on test")
         test_exs = list(transform_for_classification(read_data(args.blind_test_path)))
@@ -0,0 +1,157 @@
+# cross_validation.py
+
+import argparse
+import itertools
+import time
+import multiprocessing as mp
+from classifier_main import *
+from featurizers import CorpusStatistics, collect_statistics
+
+
+def _parse_args():
+    """
+    Command-line arguments to the cross-validation runner.
+    :return: the parsed args bundle
+    """
+    parser = argparse.ArgumentParser(description='cross_validation.py')
+    parser.add_argument('--train_path', type=str, default='data/eng.train', help='path to train set (you should not need to modify)')
+    parser.add_argument('--num_folds', type=int, default=5, help='number of folds')
+    parser.add_argument('--num_workers', type=int, default=None, help='number of processes training folds, defaults to the number of cpus')
+    parser.add_argument('--hash_dimensions', type=int, default=None, help='hash the word and pos indicator features and the word count tables into this many dimensions instead of indexing the vocabulary')
+    parser.add_argument('--num_epochs', type=int, nargs='+', default=[13], help='values of num_epochs to try')
+    parser.add_argument('--scale_toBalance', type=float, nargs='+', default=[4.0], help='values of scale_toBalance to try')
+    parser.add_argument('--batch_size', type=int, default=256, help='number of tokens per update')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=list(np.round(np.arange(0.3, 0.81, 0.05), 2)), help='decision thresholds to sweep')
+    args = parser.parse_args()
+    return args
+
+
+# training data of every fold in a worker process, set once by _init_fold_worker
+_fold_state = {}
+
+def _init_fold_worker(*fold_data):
+    _fold_state['folds'] = [attach_training_data(*training_data) for training_data in fold_data]
+
+def _train_fold(fold: int, train_rows: np.ndarray, test_rows: np.ndarray, num_epochs: int, scale_toBalance: float,
+                batch_size: int, seed: int):
+    """
+    trains on the rows of one fold as train_classifier does and scores the held out rows, both featurized by the
+    featurizer of the fold
+    :return: [len(test_rows)] sigmoid scores
+    """
+    matrix, Y = _fold_state['folds'][fold]
+    random_state = np.random.RandomState(seed)
+    optimizer = UnregularizedAdagradTrainer(random_state.rand(matrix.num_dimensions))
+    for epoch in range(num_epochs):
+        order = train_rows[random_state.permutation(len(train_rows))]
+        run_minibatches(matrix, Y, optimizer, order, scale_toBalance, batch_size)
+
+    W = rescale_weights(optimizer.get_final_weights())
+    return sigmoid(matrix.take(test_rows).dot(W))
+
+
+def evaluate_thresholds(golds: np.ndarray, scores: np.ndarray, thresholds: np.ndarray):
+    """
+    Precision, recall and F1 (as in print_evaluation) of the predictions scores > threshold, for all the
+    thresholds at once
+    :param golds: [num_tokens] 0/1 labels
+    :param scores: [num_tokens] cached sigmoid scores
+    :param thresholds: [num_thresholds]
+    :return: precision, recall and f1, each [num_thresholds]
+    """
+    predictions = scores[np.newaxis, :] > np.asarray(thresholds)[:, np.newaxis]
+    num_pred = predictions.sum(axis=1)
+    num_gold = golds.sum()
+    num_pos_correct = (predictions & (golds == 1)[np.newaxis, :]).sum(axis=1)
+    precision = num_pos_correct / np.maximum(num_pred, 1)
+    recall = num_pos_correct / max(num_gold, 1)
+    f1 = np.where(num_pos_correct > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.0)
+    return precision, recall, f1
+
+
+def fold_rows(ner_exs: List[PersonExample], num_folds: int):
+    """
+    splits the tokens into num_folds folds of whole sentences, dealing the sentences round robin
+    :return: list of the row indices (into the featurized corpus) of every fold
+    """
+    lengths = np.array([len(ex) for ex in ner_exs], dtype=int)
+    sentence_folds = np.repeat(np.arange(len(lengths)) % num_folds, lengths)
+    return [np.nonzero(sentence_folds == fold)[0] for fold in range(num_folds)]
+
+
+def fold_featurizers(ner_exs: List[PersonExample], num_folds: int, hash_dimensions=None):
+    """
+    one featurizer per fold, whose priors are computed on the other folds only, so that the labels of the held out
+    sentences do not leak into their own features. The statistics of every fold are collected once and merged for
+    the featurizers of the folds they are not held out of
+    :return: list of num_folds Featurizers
+    """
+    statistics = [collect_statistics(ner_exs[fold::num_folds], hash_dimensions=hash_dimensions)
+                  for fold in range(num_folds)]
+    featurizers = []
+    for fold in range(num_folds):
+        training_statistics = CorpusStatistics(hash_dimensions)
+        for other in range(num_folds):
+            if other != fold:
+                training_statistics.merge(statistics[other])
+        featurizers.append(Featurizer(None, hash_dimensions=hash_dimensions, statistics=training_statistics))
+    return featurizers
+
+
+def cross_validate(ner_exs: List[PersonExample], num_folds=5, epoch_values=(13,), scale_values=(4.0,), batch_size=256,
+                   thresholds=(0.55,), num_workers=None, hash_dimensions=None):
+    """
+    k-fold cross-validation of the adagrad trainer of train_classifier for every combination of num_epochs and
+    scale_toBalance. The corpus is featurized once per fold, by a featurizer built on the training folds only (see
+    fold_featurizers), and the feature matrices are shared read only with the worker processes, which train the folds
+    of all the settings in parallel. The held out scores are cached, so the decision thresholds are swept without
+    predicting again.
+    :return: dict (num_epochs, scale_toBalance) -> [num_thresholds] F1 over all the held out tokens
+    """
+    ner_exs = list(ner_exs)
+    fold_data = []
+    for featurizer in fold_featurizers(ner_exs, num_folds, hash_dimensions):
+        all_X, all_Y = featurize_examples(featurizer, ner_exs)
+        matrix = FeatureMatrix.from_compressed(all_X, featurizer.num_dimensions, featurizer.num_direct_dimensions)
+        fold_data.append(share_training_data(matrix, all_Y))
+    folds = fold_rows(ner_exs, num_folds)
+    settings = list(itertools.product(epoch_values, scale_values))
+
+    jobs = []
+    for num_epochs, scale_toBalance in settings:
+        for fold, test_rows in enumerate(folds):
+            train_rows = np.concatenate([rows for other, rows in enumerate(folds) if other != fold])
+            jobs.append((fold, train_rows, test_rows, num_epochs, scale_toBalance, batch_size, 11 + fold))
+
+    start_time = time.time()
+    with mp.Pool(num_workers, initializer=_init_fold_worker, initargs=fold_data) as pool:
+        fold_scores = pool.starmap(_train_fold, jobs)
+    print('trained {} folds in {} seconds'.format(len(jobs), time.time() - start_time))
+
+    results = {}
+    thresholds = np.asarray(thresholds)
+    for position, (num_epochs, scale_toBalance) in enumerate(settings):
+        scores = np.zeros(len(all_Y))
+        for fold, test_rows in enumerate(folds):
+            scores[test_rows] = fold_scores[position * num_folds + fold]
+        precision, recall, f1 = evaluate_thresholds(all_Y, scores, thresholds)
+        results[(num_epochs, scale_toBalance)] = f1
+
+        print('===num_epochs {}, scale_toBalance {}==='.format(num_epochs, scale_toBalance))
+        for threshold, p, r, f in zip(thresholds, precision, recall, f1):
+            print('threshold {:.2f}: precision {:.6f}, recall {:.6f}, F1 {:.6f}'.format(threshold, p, r, f))
+
+    (num_epochs, scale_toBalance), f1 = max(results.items(), key=lambda item: item[1].max())
+    print('best: num_epochs {}, scale_toBalance {}, threshold {:.2f}, F1 {:.6f}'.format(
+        num_epochs, scale_toBalance, thresholds[f1.argmax()], f1.max()))
+    return results
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    args = _parse_args()
+    print(args)
+    train_class_exs = list(transform_for_classification(read_data(args.train_path)))
+    cross_validate(train_class_exs, args.num_folds, args.num_epochs, args.scale_toBalance, args.batch_size,
+                   args.thresholds, args.num_workers, args.hash_dimensions)
+    print("Cross-validation took %f seconds" % (time.time() - start_time))
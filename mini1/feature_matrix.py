@@ -0,0 +1,119 @@
+# feature_matrix.py
+
+import numpy as np
+
+
+def compress_features(X, num_direct_dimensions):
+    """
+    splits the compressed features into the direct feature values and the indices of
+    the indicator and pos features, so that a row can be scored as
+    direct . W[:num_direct_dimensions] + sum(W[indicators]) without allocating the one
+    hot form. Indicator indices pointing inside the direct block (an unknown pos tag is
+    stored as index 0) overwrite that direct value with 1, as the one hot form of the
+    original trainer did, and are masked out in active.
+    :return: direct [n, num_direct_dimensions], indicators [n, 6] ints, active [n, 6] 0/1 mask
+    """
+    direct = np.array(X[:, 0:num_direct_dimensions], dtype=float)
+    indicators = X[:, num_direct_dimensions:].astype(int)
+    active = indicators >= num_direct_dimensions
+    rows, cols = np.nonzero(~active)
+    direct[rows, indicators[rows, cols]] = 1
+    return direct, indicators, active.astype(float)
+
+
+class FeatureMatrix(object):
+    """
+    Compact CSR representation of the expanded (one hot) features of a set of tokens. Only the
+    nonzero entries are stored, so a row costs ~20 numbers instead of num_dimensions floats.
+
+    Attributes:
+        indptr: [num_rows + 1] offsets, the entries of row i are at indptr[i]:indptr[i+1]
+        indices: [nnz] column index of every stored entry
+        data: [nnz] value of every stored entry
+        num_dimensions: number of columns, i.e. the length of the weight vector
+        gradient_data: [nnz] values used by transpose_dot. Same as data, except that a direct column is counted once
+        for every compressed feature pointing at it, as the per-token trainer counted its gradient keys (the bias-like
+        column 0 absorbs unknown pos tags this way, which the trained models depend on)
+        row_ids: [nnz] row index of every stored entry
+    """
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, num_dimensions: int,
+                 gradient_data=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.num_dimensions = num_dimensions
+        self.gradient_data = data if gradient_data is None else gradient_data
+        self.row_ids = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+    @classmethod
+    def from_compressed(cls, X: np.ndarray, num_dimensions: int, num_direct_dimensions: int):
+        """
+        Builds the matrix from the compressed [num_tokens, 22] features returned by the featurizer
+        """
+        X = np.atleast_2d(X)
+        direct, indicators, active = compress_features(X, num_direct_dimensions)
+        cols = np.hstack((np.broadcast_to(np.arange(num_direct_dimensions), direct.shape), indicators))
+        vals = np.hstack((direct, active))
+
+        key_counts = np.hstack((X[:, 0:num_direct_dimensions] != 0, active)).astype(float)
+        rows, inactive_cols = np.nonzero(active == 0)
+        np.add.at(key_counts, (rows, indicators[rows, inactive_cols]), 1)
+
+        nonzero = vals != 0
+        indptr = np.zeros(len(vals) + 1, dtype=np.int64)
+        np.cumsum(nonzero.sum(axis=1), out=indptr[1:])
+        return cls(indptr, cols[nonzero].astype(np.int64), vals[nonzero], num_dimensions,
+                   (vals * key_counts)[nonzero])
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def take(self, rows: np.ndarray):
+        """
+        :param rows: indices of the rows to gather, e.g. a shuffled minibatch
+        :return: a new FeatureMatrix holding only those rows, in the given order
+        """
+        starts = self.indptr[rows]
+        lengths = self.indptr[np.asarray(rows) + 1] - starts
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return FeatureMatrix(indptr, self.indices[positions], self.data[positions], self.num_dimensions,
+                             self.gradient_data[positions])
+
+    def dot(self, W: np.ndarray):
+        """
+        :param W: [num_dimensions] weight vector, or [num_dimensions, num_outputs] weight matrix
+        :return: [num_rows] array of the products X.W, or [num_rows, num_outputs] for a weight matrix
+        """
+        if W.ndim == 1:
+            return np.bincount(self.row_ids, weights=self.data * W[self.indices], minlength=len(self))
+        num_outputs = W.shape[1]
+        bins = (self.row_ids[:, np.newaxis] * num_outputs + np.arange(num_outputs)).ravel()
+        products = self.data[:, np.newaxis] * W[self.indices]
+        return np.bincount(bins, weights=products.ravel(), minlength=len(self) * num_outputs).reshape(-1, num_outputs)
+
+    def rmatvec(self, r: np.ndarray):
+        """
+        Exact dense product X^T.r over the stored values, e.g. the full gradient of a linear model
+        :param r: [num_rows] per row coefficients
+        :return: [num_dimensions] array
+        """
+        return np.bincount(self.indices, weights=self.data * r[self.row_ids], minlength=self.num_dimensions)
+
+    def transpose_dot(self, r: np.ndarray):
+        """
+        Sparse product X^T.r, e.g. the gradient of a linear model given the per row residuals r
+        :param r: [num_rows] per row coefficients, or [num_rows, num_outputs] for one set of coefficients per output
+        :return: (indices, values) of the nonzero columns, with duplicate columns summed; values is
+        [num_columns, num_outputs] for 2d coefficients
+        """
+        columns, inverse = np.unique(self.indices, return_inverse=True)
+        if r.ndim == 2:
+            num_outputs = r.shape[1]
+            bins = (inverse[:, np.newaxis] * num_outputs + np.arange(num_outputs)).ravel()
+            products = self.gradient_data[:, np.newaxis] * r[self.row_ids]
+            values = np.bincount(bins, weights=products.ravel(), minlength=len(columns) * num_outputs)
+            return columns, values.reshape(-1, num_outputs)
+        values = np.bincount(inverse, weights=self.gradient_data * r[self.row_ids], minlength=len(columns))
+        return columns, values
@@ -8,6 +8,8 @@ from optimizers import *
 from typing import List
 # from classifier_main import PersonExample, transform_for_classification
 import re
+import zlib
+import multiprocessing
 
 
 def _parse_args():
@@ -53,159 +55,428 @@ def transform_for_classification(ner_exs: List[LabeledSentence]):
         yield PersonExample([tok.word for tok in labeled_sent.tokens], labels)
 
 
-def generate_vocabDict(ner_exs: List[PersonExample]):
-
-    vocab_dict = {}
-    index = 0
-    for ex in ner_exs:
-        for token in ex.tokens:
-            if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
-                if token.lower() not in vocab_dict:
-                    vocab_dict[token.lower()] = index
-                    index += 1
-    return vocab_dict
-
-def get_frequencyDict(ner_exs: List[PersonExample]):
-
-    frequency_dict = {}
-    inverse_document_dict = {}
-    for ex in ner_exs:
-        for token in ex.tokens:
-            if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
-                if token.lower() not in frequency_dict:
-                    frequency_dict[token.lower()] = 1
-                else:
-                    frequency_dict[token.lower()] += 1
-        
-        for token in list(set(ex.tokens)):
-
-             if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
-                if token.lower() not in inverse_document_dict:
-                    inverse_document_dict[token.lower()] = 1
-                else:
-                    inverse_document_dict[token.lower()] += 1
-        
-    # for key, value in sorted(frequency_dict.items(), key=lambda item: item[1]):
-    #     print("%s: %s" % (key, value))
-
-    return frequency_dict, inverse_document_dict
+class CorpusStatistics(object):
+    """
+    Collects in a single pass over the training corpus all the tables the Featurizer needs. Only the tokens matching
+    the word pattern are counted, lowercased; the pattern is matched once per word type and cached. Statistics of
+    consecutive shards of a corpus can be combined with merge, giving the same tables as a single pass over the whole
+    corpus. With hash_dimensions, the count tables are keyed by hash_feature(word, hash_dimensions) instead of the
+    word, so that their size is bounded by hash_dimensions; colliding words share their counts.
 
-def get_frequentNameDict(ner_exs: List[PersonExample]):
+    Attributes:
+        vocab_dict: word -> index, in order of first occurrence (empty with hash_dimensions)
+        frequency_dict: word -> number of occurrences
+        inverse_document_dict: word -> number of sentences containing it
+        frequentNameDict: word -> number of occurrences as a person token
+        oneBeforeNameDict, twoBeforeNameDict, oneAfterNameDict: word -> number of occurrences as a non person token
+        one before, two before and one after a person token
+        pos_dict: pos tag -> index, in order of first occurrence
+        num_docs: number of sentences seen
+        entity_types: the entity types of the type_labels of the examples, None if they have none
+        prior_types: the entity types other than PER whose name priors are counted as well
+        type_name_dicts: for every type of prior_types, its four name tables, in name_tables order, counted as the
+        person ones on the tokens of that type
+    """
+    word_pattern = re.compile('^[a-zA-Z][\w-]+$')   #only words and not numbers, dates etc.
+    name_tables = ('frequentNameDict', 'oneBeforeNameDict', 'twoBeforeNameDict', 'oneAfterNameDict')
+
+    def __init__(self, hash_dimensions=None, entity_types=None):
+        self.hash_dimensions = hash_dimensions
+        self.entity_types = entity_types
+        self.prior_types = [entity_type for entity_type in entity_types or [] if entity_type != 'PER']
+        self.prior_columns = [entity_types.index(entity_type) for entity_type in self.prior_types]
+        self.type_name_dicts = [[Counter() for name in self.name_tables] for entity_type in self.prior_types]
+        self.index_vocabulary = hash_dimensions is None
+        self.vocab_dict = {}
+        self.frequency_dict = Counter()
+        self.inverse_document_dict = Counter()
+        self.frequentNameDict = Counter()
+        self.oneBeforeNameDict = Counter()
+        self.twoBeforeNameDict = Counter()
+        self.oneAfterNameDict = Counter()
+        self.pos_dict = {}
+        self.num_docs = 0
+        self.word_cache = {}
+        self.key_cache = {}
+
+    def as_word(self, token: str):
+        """
+        :return: the lowercased token if it matches the word pattern, None otherwise (cached per token)
+        """
+        if token not in self.word_cache:
+            lower = token.lower()
+            self.word_cache[token] = lower if self.word_pattern.match(lower) else None
+        return self.word_cache[token]
+
+    def word_key(self, word: str):
+        """
+        :return: the key of a word in the count tables: the word itself, or its bucket with hash_dimensions
+        """
+        return word if self.hash_dimensions is None else hash_feature(word, self.hash_dimensions)
+
+    def as_key(self, token: str):
+        """
+        :return: word_key of the lowercased token if it matches the word pattern, None otherwise (cached per token)
+        """
+        if token not in self.key_cache:
+            word = self.as_word(token)
+            self.key_cache[token] = None if word is None else self.word_key(word)
+        return self.key_cache[token]
+
+    def name_counts(self):
+        """
+        :return: the name tables of the person labels followed by the ones of every type of prior_types
+        """
+        return [[getattr(self, name) for name in self.name_tables]] + self.type_name_dicts
+
+    def tables(self):
+        """
+        :return: all the count tables, in the column order of the Featurizer word counts
+        """
+        return [self.frequency_dict, self.inverse_document_dict] + [table for tables in self.name_counts()
+                                                                    for table in tables]
+
+    @staticmethod
+    def count_names(words, labels, tables):
+        """
+        counts the words of a sentence labelled as names, and the ones one before, two before and one after a name
+        :param words: count table key of every token, None for the tokens that are not words
+        :param labels: 1 for the name tokens
+        :param tables: the four name tables to count into, in name_tables order
+        """
+        n = len(words)
+        name, oneBefore, twoBefore, oneAfter = tables
+        for i, word in enumerate(words):
+            if word is None:
+                continue
+            if labels[i] == 1:
+                name[word] += 1
+            else:
+                if i < n-1 and labels[i+1] == 1:
+                    oneBefore[word] += 1
+                if i < n-2 and labels[i+2] == 1:
+                    twoBefore[word] += 1
+                if i < n-1 and labels[i-1] == 1:
+                    oneAfter[word] += 1
+
+    def add_example(self, tokens: List[str], pos_tags: List[str], labels: List[int], type_labels=None):
+        """
+        :param type_labels: [len(tokens), len(entity_types)] 0/1 array, needed if entity_types is given
+        """
+        words = [self.as_key(token) for token in tokens]
+        for word in words:
+            if word is None:
+                continue
+            if self.index_vocabulary and word not in self.vocab_dict:
+                self.vocab_dict[word] = len(self.vocab_dict)
+            self.frequency_dict[word] += 1
+        self.count_names(words, labels, self.name_counts()[0])
+        for column, tables in zip(self.prior_columns, self.type_name_dicts):
+            self.count_names(words, type_labels[:, column], tables)
+
+        for token in set(tokens):
+            word = self.as_key(token)
+            if word is not None:
+                self.inverse_document_dict[word] += 1
+
+        for pos in pos_tags:
+            tag = self.as_word(pos)
+            if tag is not None and tag not in self.pos_dict:
+                self.pos_dict[tag] = len(self.pos_dict)
+
+        self.num_docs += 1
+
+    def add_examples(self, exs):
+        for ex in exs:
+            self.add_example(ex.tokens, ex.pos_tags, ex.labels, ex.type_labels)
+        return self
+
+    @classmethod
+    def from_store(cls, store: CorpusStore, hash_dimensions=None, entity_types=None):
+        """
+        Same statistics as add_examples over the sentences of store, counted over its id arrays: the word pattern is
+        matched once per word id and the per token conditions are evaluated for all the tokens at once
+        """
+        statistics = cls(hash_dimensions, entity_types)
+        words = [statistics.as_word(word) for word in store.strings('word')]
+        lower_index = {}
+        for word in words:
+            if word is not None and word not in lower_index:
+                lower_index[word] = len(lower_index)
+        lower_keys = [statistics.word_key(word) for word in lower_index]
+        if statistics.index_vocabulary:
+            statistics.vocab_dict = dict(lower_index)
+        for pos in store.strings('pos'):
+            tag = statistics.as_word(pos)
+            if tag is not None and tag not in statistics.pos_dict:
+                statistics.pos_dict[tag] = len(statistics.pos_dict)
+
+        #lowercased word of every token, -1 for the tokens that are not words
+        word_ids = np.asarray(store.word_ids, dtype=np.int64)
+        type_lower_ids = np.array([-1 if word is None else lower_index[word] for word in words], dtype=np.int64)
+        lower_ids = type_lower_ids[word_ids]
+        labels = person_labels(store)
+        lengths = store.lengths()
+        idx = np.arange(len(word_ids)) - np.repeat(np.asarray(store.offsets[:-1]), lengths)
+        n = np.repeat(lengths, lengths)
+        is_word = lower_ids >= 0
+
+        def keyed(counts):
+            table = Counter()
+            for i in np.nonzero(counts)[0]:
+                table[lower_keys[i]] += int(counts[i])
+            return table
+
+        def count(mask):
+            return keyed(np.bincount(lower_ids[is_word & mask], minlength=len(lower_keys)))
+
+        def count_names(labels):
+            next_label, next2_label = np.roll(labels, -1), np.roll(labels, -2)
+            #labels[i-1] of the first token of a sentence is the label of its last token
+            prev_label = np.where(idx == 0, labels[np.minimum(np.arange(len(labels)) + n - 1, len(labels) - 1)],
+                                  np.roll(labels, 1))
+            other = labels != 1
+            return [count(labels == 1), count(other & (idx < n-1) & (next_label == 1)),
+                    count(other & (idx < n-2) & (next2_label == 1)), count(other & (idx < n-1) & (prev_label == 1))]
+
+        statistics.frequency_dict = count(True)
+        for name, table in zip(statistics.name_tables, count_names(labels)):
+            setattr(statistics, name, table)
+        statistics.type_name_dicts = [count_names(entity_labels(store, entity_type))
+                                      for entity_type in statistics.prior_types]
+
+        #documents are counted once per distinct token of the sentence, as in add_example
+        sentence_ids = np.repeat(np.arange(len(store)), lengths)
+        distinct = np.unique(sentence_ids[is_word] * (len(words) + 1) + word_ids[is_word]) % (len(words) + 1)
+        statistics.inverse_document_dict = keyed(np.bincount(type_lower_ids[distinct], minlength=len(lower_keys)))
+        statistics.num_docs = len(store)
+        return statistics
+
+    def merge(self, other):
+        """
+        Adds the statistics of other, collected on the shard of the corpus that follows this one
+        :return: self
+        """
+        for word in other.vocab_dict:
+            if word not in self.vocab_dict:
+                self.vocab_dict[word] = len(self.vocab_dict)
+        for tag in other.pos_dict:
+            if tag not in self.pos_dict:
+                self.pos_dict[tag] = len(self.pos_dict)
+        self.frequency_dict.update(other.frequency_dict)
+        self.inverse_document_dict.update(other.inverse_document_dict)
+        self.frequentNameDict.update(other.frequentNameDict)
+        self.oneBeforeNameDict.update(other.oneBeforeNameDict)
+        self.twoBeforeNameDict.update(other.twoBeforeNameDict)
+        self.oneAfterNameDict.update(other.oneAfterNameDict)
+        for tables, other_tables in zip(self.type_name_dicts, other.type_name_dicts):
+            for table, other_table in zip(tables, other_tables):
+                table.update(other_table)
+        self.num_docs += other.num_docs
+        return self
+
+    def hashed_counts(self):
+        """
+        :return: [hash_dimensions, len(tables())] int32 array of the counts of every bucket in every table
+        """
+        tables = self.tables()
+        counts = np.zeros((self.hash_dimensions, len(tables)), dtype=np.int32)
+        for column, table in enumerate(tables):
+            counts[list(table.keys()), column] = list(table.values())
+        return counts
+
+
+def _collect_shard(shard, hash_dimensions=None, entity_types=None):
+    statistics = CorpusStatistics(hash_dimensions, entity_types)
+    for tokens, pos_tags, labels, type_labels in shard:
+        statistics.add_example(tokens, pos_tags, labels, type_labels)
+    statistics.word_cache = {}
+    statistics.key_cache = {}
+    return statistics
+
+
+def collect_statistics(exs: List[PersonExample], num_workers=1, hash_dimensions=None, entity_types=None):
+    """
+    :param exs: training examples
+    :param num_workers: number of processes; the corpus is split in that many consecutive shards whose
+    statistics are merged in order
+    :param hash_dimensions: if given, the count tables are hashed into this many buckets and vocab_dict is not built
+    :param entity_types: the entity types of the type_labels of exs, whose name priors are counted besides the
+    person ones (taken from the tags for a CorpusStore)
+    :return: CorpusStatistics of the whole corpus
+    """
+    if isinstance(exs, CorpusStore):
+        return CorpusStatistics.from_store(exs, hash_dimensions, entity_types)
+    if num_workers <= 1:
+        return CorpusStatistics(hash_dimensions, entity_types).add_examples(exs)
 
-    frequentNameDict = {}
-    for ex in ner_exs:
-        for i, token in enumerate(ex.tokens):
-            if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
+    data = [(ex.tokens, ex.pos_tags, ex.labels, ex.type_labels) for ex in exs]
+    shard_size = (len(data) + num_workers - 1) // num_workers
+    shards = [data[start:start + shard_size] for start in range(0, len(data), shard_size)]
+    with multiprocessing.Pool(num_workers) as pool:
+        partials = pool.starmap(_collect_shard, [(shard, hash_dimensions, entity_types) for shard in shards])
 
-                if ex.labels[i] == 1:
-                    if token.lower() not in frequentNameDict:
-                        frequentNameDict[token.lower()] = 1
-                    else:
-                        frequentNameDict[token.lower()] += 1
+    statistics = CorpusStatistics(hash_dimensions, entity_types)
+    for partial in partials:
+        statistics.merge(partial)
+    return statistics
 
-    # for key, value in sorted(frequentNameDict.items(), key=lambda item: item[1]):
-    #     print("%s: %s" % (key, value))
 
-    return frequentNameDict
-    
+def person_labels(store: CorpusStore):
+    """
+    :return: [num_tokens] 0/1 array of the person labels of the tokens of store, as transform_for_classification
+    """
+    is_person = np.array([tag.endswith("PER") for tag in store.strings('tag')], dtype=int)
+    return is_person[np.asarray(store.tag_ids)]
 
-def get_oneBeforeNameDict(ner_exs: List[PersonExample]):
 
-    oneBeforeNameDict = {}
-    for ex in ner_exs:
-        for i, token in enumerate(ex.tokens):
-            if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
+def entity_labels(store: CorpusStore, entity_type: str):
+    """
+    :return: [num_tokens] 0/1 array of the labels of the tokens of store for entity_type, as the type_labels of
+    transform_for_classification
+    """
+    is_type = np.array([tag[2:] == entity_type for tag in store.strings('tag')], dtype=int)
+    return is_type[np.asarray(store.tag_ids)]
 
-                if i<len(ex)-1 and ex.labels[i+1] == 1 and ex.labels[i]!=1:
-                    if token.lower() not in oneBeforeNameDict:
-                        oneBeforeNameDict[token.lower()] = 1
-                    else:
-                        oneBeforeNameDict[token.lower()] += 1
 
-    # for key, value in sorted(oneBeforeNameDict.items(), key=lambda item: item[1]):
-    #     print("%s: %s" % (key, value))
+def hash_feature(feature: str, hash_dimensions: int):
+    """
+    stable (process independent) hash of a feature string into [0, hash_dimensions)
+    """
+    return zlib.crc32(feature.encode('utf-8')) % hash_dimensions
 
-    return oneBeforeNameDict
 
-def get_twoBeforeNameDict(ner_exs: List[PersonExample]):
+class SortedVocabulary(object):
+    """
+    Read only word -> index mapping over an array of the utf-8 encoded words in sorted order, e.g. memory mapped, and
+    the index of each of them; the words are looked up by binary search
+    """
 
-    twoBeforeNameDict = {}
-    for ex in ner_exs:
-        for i, token in enumerate(ex.tokens):
-            if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
+    def __init__(self, words: np.ndarray, indices: np.ndarray):
+        self.words = words
+        self.indices = indices
+
+    def row(self, word: str):
+        """
+        :return: position of word in words, -1 if it is absent
+        """
+        key = word.encode('utf-8')
+        position = int(np.searchsorted(self.words, key))
+        if position < len(self.words) and self.words[position] == key:
+            return position
+        return -1
+
+    def __contains__(self, word):
+        return self.row(word) >= 0
+
+    def __getitem__(self, word):
+        position = self.row(word)
+        if position < 0:
+            raise KeyError(word)
+        return int(self.indices[position])
 
-                if i<len(ex)-2 and ex.labels[i+2] == 1 and ex.labels[i]!=1:
-                    if token.lower() not in twoBeforeNameDict:
-                        twoBeforeNameDict[token.lower()] = 1
-                    else:
-                        twoBeforeNameDict[token.lower()] += 1
+    def __len__(self):
+        return len(self.words)
 
-    # for key, value in sorted(twoBeforeNameDict.items(), key=lambda item: item[1]):
-    #     print("%s: %s" % (key, value))
+    def __iter__(self):
+        return (word.decode('utf-8') for word in self.words)
 
-    return twoBeforeNameDict
 
-def get_oneAfterNameDict(ner_exs: List[PersonExample]):
+class HashedRows(object):
+    """
+    Maps the words matching the word pattern to their bucket, the row of their counts in the hashed count tables
+    """
 
-    oneAfterNameDict = {}
-    for ex in ner_exs:
-        for i, token in enumerate(ex.tokens):
-            if re.match('^[a-zA-Z][\w-]+$', token.lower()):   #only words and not numbers, dates etc.
+    def __init__(self, hash_dimensions: int):
+        self.hash_dimensions = hash_dimensions
 
-                if i<len(ex)-1 and ex.labels[i-1] == 1 and ex.labels[i]!=1:
-                    if token.lower() not in oneAfterNameDict:
-                        oneAfterNameDict[token.lower()] = 1
-                    else:
-                        oneAfterNameDict[token.lower()] += 1
+    def row(self, word: str):
+        if CorpusStatistics.word_pattern.match(word) is None:
+            return -1
+        return hash_feature(word, self.hash_dimensions)
 
-    # for key, value in sorted(oneAfterNameDict.items(), key=lambda item: item[1]):
-    #     print("%s: %s" % (key, value))
-    #threshold is heuristically selected to be 2
 
-    return oneAfterNameDict
+class CountTable(object):
+    """
+    Read only view of one column of a [num_rows, 6] count array that answers the lookups of the word -> count dicts:
+    a word is in the table if rows.row gives it a row with a nonzero count
+    """
 
-def get_posDict(ner_exs: List[PersonExample]):
-    pos_dict = {}
-    index = 0
-    for ex in ner_exs:
-        for i, pos in enumerate(ex.pos_tags):
-           if re.match('^[a-zA-Z][\w-]+$', pos.lower()):   #only words and not numbers, dates etc.
+    def __init__(self, counts: np.ndarray, rows):
+        self.counts = counts
+        self.rows = rows
 
-                if pos.lower() not in pos_dict:
-                    pos_dict[pos.lower()] = index
-                    index += 1
+    def get(self, word, default=None):
+        row = self.rows.row(word)
+        if row < 0 or self.counts[row] == 0:
+            return default
+        return int(self.counts[row])
 
-    total_posTags = index
-                
-    return pos_dict, index
+    def __contains__(self, word):
+        return self.get(word) is not None
 
+    def __getitem__(self, word):
+        count = self.get(word)
+        if count is None:
+            raise KeyError(word)
+        return count
 
+    def values(self):
+        return self.counts[np.nonzero(self.counts)[0]].tolist()
 
 
 class Featurizer():
 
 
-    def __init__(self, train_class_exs: List[PersonExample]):
+    count_tables = ('frequencyDict', 'inverse_document_dict', 'frequentNameDict', 'oneBeforeNameDict',
+                    'twoBeforeNameDict', 'oneAfterNameDict')
+
+    def __init__(self, train_class_exs: List[PersonExample], num_workers=1, hash_dimensions=None, statistics=None,
+                 word_counts=None, entity_types=None):
         '''
         used to initiialize the featurizer and calculate various priors of the train set
+        :param num_workers: number of processes used to collect the corpus statistics
+        :param hash_dimensions: if given, the word and pos indicator features are hashed into this many
+        dimensions instead of being indexed by the vocabulary, and the frequency and name prior tables are
+        hashed into as many buckets, so the size of the model does not depend on the training data
+        :param statistics: CorpusStatistics to use instead of collecting them from train_class_exs
+        :param word_counts: [num_rows, 6 + 4*len(prior_types)] counts of the count_tables and of the name tables of
+        the prior types to use instead of the ones of statistics, one row per bucket with hash_dimensions and per
+        word of statistics.vocab_dict (a SortedVocabulary) otherwise
+        :param entity_types: the entity types of the type_labels of train_class_exs; the name priors of the ones
+        other than PER are featurized as 4 more direct features each, after the bias
         '''
-        self.vocab_dict = generate_vocabDict(train_class_exs)
-        self.frequencyDict, self.inverse_document_dict =  get_frequencyDict(train_class_exs)
-        self.frequentNameDict = get_frequentNameDict(train_class_exs)
-        self.oneBeforeNameDict = get_oneBeforeNameDict(train_class_exs)
-        self.twoBeforeNameDict = get_twoBeforeNameDict(train_class_exs)
-        self.oneAfterNameDict = get_oneAfterNameDict(train_class_exs)
-        self.pos_dict, self.total_posTags = get_posDict(train_class_exs)
+        self.hash_dimensions = hash_dimensions
+        if statistics is None:
+            statistics = collect_statistics(train_class_exs, num_workers, hash_dimensions, entity_types)
+        self.vocab_dict = statistics.vocab_dict
+        self.prior_types = statistics.prior_types
+        if hash_dimensions is None and word_counts is None:
+            self.frequencyDict, self.inverse_document_dict = dict(statistics.frequency_dict), dict(statistics.inverse_document_dict)
+            self.frequentNameDict = dict(statistics.frequentNameDict)
+            self.oneBeforeNameDict = dict(statistics.oneBeforeNameDict)
+            self.twoBeforeNameDict = dict(statistics.twoBeforeNameDict)
+            self.oneAfterNameDict = dict(statistics.oneAfterNameDict)
+            self.type_name_dicts = [[dict(table) for table in tables] for tables in statistics.type_name_dicts]
+        else:
+            if word_counts is None:
+                word_counts = statistics.hashed_counts()
+            rows = self.vocab_dict if hash_dimensions is None else HashedRows(hash_dimensions)
+            for column, name in enumerate(self.count_tables):
+                setattr(self, name, CountTable(word_counts[:, column], rows))
+            self.type_name_dicts = [[CountTable(word_counts[:, column], rows) for column in range(start, start + 4)]
+                                    for start in range(len(self.count_tables), word_counts.shape[1], 4)]
+        self.pos_dict, self.total_posTags = statistics.pos_dict, len(statistics.pos_dict)
 
         self.vocab_size = len(self.vocab_dict)  
-        self.num_dimensions = 15 + 1 + 3*(self.vocab_size + 1) + 3*self.total_posTags #plus one for bias, plus 3 for none of the words
-        self.num_direct_dimensions = 15 + 1 # 1 is bias
+        self.num_direct_dimensions = 15 + 1 + 4*len(self.prior_types) # 1 is bias, then the priors of the other types
+        self.num_dimensions = self.num_direct_dimensions + 3*(self.vocab_size + 1) + 3*self.total_posTags #plus 3 for none of the words
+        if hash_dimensions is not None:
+            self.num_dimensions = self.num_direct_dimensions + hash_dimensions
 
         #for tf-idf
-        self.total_frequencyDict = 0.0
-        for key, value in self.frequencyDict.items():
-            self.total_frequencyDict += value       
-        self.total_docs = len(train_class_exs)
+        self.total_frequencyDict = float(sum(self.frequencyDict.values()))
+        self.total_docs = statistics.num_docs
 
         #for frequency features
         self.max_frequencyDict = max(self.frequencyDict.values())
@@ -213,12 +484,68 @@ class Featurizer():
         self.max_oneBeforeNameDict = max(self.oneBeforeNameDict.values())
         self.max_twoBeforeNameDict = max(self.oneBeforeNameDict.values())
         self.max_oneAfterNameDict = max(self.oneAfterNameDict.values())
-
+        self.max_type_name_dicts = [[max(table.values(), default=1) for table in tables]
+                                    for tables in self.type_name_dicts]
+
+        #per-type rows for featurize_corpus, filled lazily as new words and pos tags are seen
+        self.type_row_size = 15 + 4*len(self.prior_types)
+        self.type_index = {}
+        self.type_table = np.zeros((0, self.type_row_size))
+        self.pos_index = {}
+        self.pos_table = np.zeros((0, 3), dtype=int)
+
+        #indicators used when there is no previous or next token
+        self.start_indicators = self.word_indicators('<s>')[1], self.pos_indicators('<S>')[1]
+        self.end_indicators = self.word_indicators('</s>')[2], self.pos_indicators('</S>')[2]
+
+        if hash_dimensions is not None:
+            print('hash dimensions: {}'.format(hash_dimensions))
         print('vocabulary size: {}'.format(self.vocab_size))
         print('number of pos tags: {}'.format(self.total_posTags))
         print('number of dimensions: {}'.format(self.num_dimensions))
-        
-       
+
+    def to_arrays(self):
+        '''
+        the tables of the featurizer as flat numpy arrays, see from_arrays
+        :return: dict with the utf-8 encoded words of the vocabulary in sorted order (every count table is keyed by
+        a subset of them) and their vocabulary indices, their [num_words, 6 + 4*len(prior_types)] counts in
+        count_tables and in the name tables of the prior types (0 when absent), the pos tags in index order, the
+        prior types, and the number of training sentences and hash dimensions (0 when not hashing). When hashing,
+        there are no words and the counts are the [hash_dimensions, 6 + 4*len(prior_types)] hashed counts
+        '''
+
+        tables = [getattr(self, name) for name in self.count_tables]
+        tables += [table for type_tables in self.type_name_dicts for table in type_tables]
+        if self.hash_dimensions is not None:
+            words = []
+            counts = np.stack([table.counts for table in tables], axis=1)
+        else:
+            words = sorted(self.vocab_dict)
+            counts = np.array([[table.get(word, 0) for table in tables] for word in words], dtype=np.int64)
+        return {'words': np.array([word.encode('utf-8') for word in words], dtype=bytes),
+                'word_indices': np.array([self.vocab_dict[word] for word in words], dtype=np.int64),
+                'word_counts': counts.reshape(-1, len(tables)),
+                'pos_tags': encode_strings(list(self.pos_dict)),
+                'prior_types': encode_strings(self.prior_types),
+                'corpus': np.array([self.total_docs, self.hash_dimensions or 0], dtype=np.int64)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''
+        rebuilds a featurizer identical to the one to_arrays was called on, without the training data
+        :param arrays: mapping from the names returned by to_arrays to the arrays, e.g. memory mapped files. The
+        words and counts are used as they are, through a SortedVocabulary and CountTables; only the pos tags are
+        decoded
+        '''
+
+        num_docs, hash_dimensions = (int(value) for value in arrays['corpus'])
+        statistics = CorpusStatistics(hash_dimensions or None, decode_strings(arrays['prior_types']))
+        if not hash_dimensions:
+            statistics.vocab_dict = SortedVocabulary(arrays['words'], arrays['word_indices'])
+        statistics.pos_dict = {tag: index for index, tag in enumerate(decode_strings(arrays['pos_tags']))}
+        statistics.num_docs = num_docs
+        return cls(None, hash_dimensions=hash_dimensions or None, statistics=statistics,
+                   word_counts=arrays['word_counts'])
 
 
 
@@ -232,6 +559,36 @@ class Featurizer():
 
         return tf*idf
 
+    def word_indicators(self, word):
+        '''
+        indices of the indicator features of a lowercased word when it is the current, previous and next token
+        '''
+
+        if self.hash_dimensions is not None:
+            return [self.num_direct_dimensions + hash_feature(slot + word, self.hash_dimensions)
+                    for slot in ('w0=', 'w-1=', 'w+1=')]
+
+        start = self.num_direct_dimensions
+        if word in self.vocab_dict:
+            index = self.vocab_dict[word]
+            return [start + index, start + index + self.vocab_size + 1, start + index + 2*self.vocab_size + 2]
+        return [start + self.vocab_size, start + 2*self.vocab_size + 1, start + 3*self.vocab_size + 2] #words not in vocab
+
+    def pos_indicators(self, pos_tag):
+        '''
+        indices of the pos features of a pos tag when it is the tag of the current, previous and next token
+        (0 for unknown tags when not hashing)
+        '''
+
+        if self.hash_dimensions is not None:
+            return [self.num_direct_dimensions + hash_feature(slot + pos_tag.lower(), self.hash_dimensions)
+                    for slot in ('p0=', 'p-1=', 'p+1=')]
+
+        if pos_tag.lower() in self.pos_dict:
+            index = self.num_direct_dimensions + 3*self.vocab_size + 3 + self.pos_dict[pos_tag.lower()]
+            return [index, index + self.total_posTags, index + 2*self.total_posTags]
+        return [0, 0, 0]
+
     
     def featurize(self, tokens: List[str], pos_tags: List[str]):
         '''
@@ -240,15 +597,162 @@ class Featurizer():
 
         assert len(tokens) == len(pos_tags)
 
-        vocab_size = self.vocab_size
-        features_list = []
-        for i, token in enumerate(tokens):
+        return self.featurize_corpus([tokens], [pos_tags])
 
-            pos_tag = pos_tags[i]
-            feature = self.featurize_oneInstance(tokens, pos_tags, i)
-            features_list.append(feature)
-        
-        return features_list
+    def type_row(self, token):
+        '''
+        the features of a word that do not depend on its position, computed once per word type:
+        the shape features (1 to 6 of featurize_oneInstance), the name and frequency priors,
+        the tf-idf and the word indicators as current, previous and next token, then the four
+        name priors of every prior type
+        '''
+
+        lower = token.lower()
+        row = np.zeros(self.type_row_size)
+        row[0] = int(re.match('[A-Z][\w-]+$', token) is not None)
+        row[1] = int(re.match('^[\d]+$', token) is not None)
+        row[2] = int(re.match('^[\d][\d-]+[-]+[\d-]+$', token) is not None)
+        row[3] = int(re.match('^[a-zA-Z][\w-]+$', token) is not None)
+        row[4] = int(re.match('^[a-zA-Z][\w-]+[-]+[\w-]+$', token) is not None)
+        row[5] = int(re.match('^[a-zA-Z][\w-]+$', token) is not None) * len(token) / 10.0
+
+        if lower in self.frequentNameDict:
+            row[6] = self.frequentNameDict[lower]/ self.max_frequentNameDict
+        if lower in self.frequencyDict:
+            row[7] = self.frequencyDict[lower]/ self.max_frequencyDict
+        if lower in self.oneBeforeNameDict:
+            row[8] = self.oneBeforeNameDict[lower]/ self.max_oneBeforeNameDict
+        if lower in self.twoBeforeNameDict:
+            row[9] = self.twoBeforeNameDict[lower]/ self.max_twoBeforeNameDict
+        if lower in self.oneAfterNameDict:
+            row[10] = self.oneAfterNameDict[lower]/ self.max_oneAfterNameDict
+
+        row[11] = self.get_tf_idf(lower)
+        row[12:15] = self.word_indicators(lower)
+
+        column = 15
+        for tables, max_counts in zip(self.type_name_dicts, self.max_type_name_dicts):
+            for table, max_count in zip(tables, max_counts):
+                if lower in table:
+                    row[column] = table[lower]/ max_count
+                column += 1
+        return row
+
+    def get_type_ids(self, tokens: List[str]):
+        '''
+        maps tokens to their rows in type_table, adding rows for the word types not seen so far
+        '''
+
+        new_types = [token for token in dict.fromkeys(tokens) if token not in self.type_index]
+        if len(self.type_index) + len(new_types) > len(self.type_table):
+            #grow geometrically so that featurizing sentence by sentence stays linear
+            grown = np.zeros((max(2*len(self.type_table), len(self.type_index) + len(new_types), 1024),
+                              self.type_row_size))
+            grown[0:len(self.type_index)] = self.type_table[0:len(self.type_index)]
+            self.type_table = grown
+        for token in new_types:
+            self.type_table[len(self.type_index)] = self.type_row(token)
+            self.type_index[token] = len(self.type_index)
+
+        return np.array([self.type_index[token] for token in tokens], dtype=int)
+
+    def get_pos_ids(self, pos_tags: List[str]):
+        '''
+        maps pos tags to their rows in pos_table, which holds their pos_indicators
+        '''
+
+        new_tags = [pos_tag for pos_tag in dict.fromkeys(pos_tags) if pos_tag not in self.pos_index]
+        if len(new_tags) > 0:
+            for pos_tag in new_tags:
+                self.pos_index[pos_tag] = len(self.pos_index)
+            self.pos_table = np.vstack([self.pos_table] + [self.pos_indicators(pos_tag) for pos_tag in new_tags])
+
+        return np.array([self.pos_index[pos_tag] for pos_tag in pos_tags], dtype=int)
+
+    def featurize_corpus(self, sentences: List[List[str]], pos_sentences: List[List[str]]):
+        '''
+        featurization over a list of sentences at once, identical to calling featurize_oneInstance
+        on every token. The per-type rows are gathered for all the tokens, and the features of the
+        previous and next tokens are obtained by shifting the gathered rows within each sentence.
+        :return: [total number of tokens, num_direct_dimensions + 6] array
+        '''
+
+        lengths = np.array([len(tokens) for tokens in sentences], dtype=int)
+        if lengths.sum() == 0:
+            return np.zeros((0, self.num_direct_dimensions + 3 + 3))
+
+        type_ids = self.get_type_ids([token for tokens in sentences for token in tokens])
+        pos_ids = self.get_pos_ids([pos_tag for pos_tags in pos_sentences for pos_tag in pos_tags])
+        return self.featurize_ids(type_ids, pos_ids, lengths)
+
+    def featurize_store(self, store: CorpusStore):
+        '''
+        featurize_corpus over the sentences of a CorpusStore: the rows of type_table and pos_table are looked up
+        once per word and pos id of the store instead of once per token
+        '''
+
+        if store.num_tokens() == 0:
+            return np.zeros((0, self.num_direct_dimensions + 3 + 3))
+
+        type_ids = self.get_type_ids(store.strings('word'))[np.asarray(store.word_ids)]
+        pos_ids = self.get_pos_ids(store.strings('pos'))[np.asarray(store.pos_ids)]
+        return self.featurize_ids(type_ids, pos_ids, store.lengths())
+
+    def featurize_ids(self, type_ids: np.ndarray, pos_ids: np.ndarray, lengths: np.ndarray):
+        '''
+        :param type_ids: [num_tokens] rows of type_table of the tokens, sentence after sentence
+        :param pos_ids: [num_tokens] rows of pos_table of the tokens
+        :param lengths: [num_sentences] number of tokens of every sentence
+        :return: [num_tokens, num_direct_dimensions + 6] array
+        '''
+
+        num_tokens = int(lengths.sum())
+        features = np.zeros((num_tokens, self.num_direct_dimensions + 3 + 3))
+        rows = self.type_table[type_ids]
+        pos = self.pos_table[pos_ids]
+
+        #position of every token in its sentence, and whether its neighbors exist
+        idx = np.arange(num_tokens) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        has_prev = idx >= 1
+        has_prev2 = idx >= 2
+        has_next = idx < np.repeat(lengths, lengths) - 1
+
+        prev_rows, prev2_rows, next_rows = np.roll(rows, 1, axis=0), np.roll(rows, 2, axis=0), np.roll(rows, -1, axis=0)
+        prev_pos, next_pos = np.roll(pos, 1, axis=0), np.roll(pos, -1, axis=0)
+
+        #word pattern and frequency features
+        features[:, 0] = idx == 0
+        features[:, 1:9] = rows[:, 0:8]
+        features[:, 9] = np.where(has_prev, prev_rows[:, 8], 0)
+        features[:, 10] = np.where(has_prev2, prev2_rows[:, 9], 0)
+        features[:, 11] = np.where(has_next, next_rows[:, 10], 0)
+
+        #tf - idf features
+        features[:, 12] = rows[:, 11]
+        features[:, 13] = np.where(has_prev, prev_rows[:, 11], 0)
+        features[:, 14] = np.where(has_next, next_rows[:, 11], 0)
+
+        #bias
+        features[:, 15] = 1
+
+        #name priors of the other types, as features 7, 9, 10 and 11 are for persons
+        for start in range(16, self.num_direct_dimensions, 4):
+            features[:, start] = rows[:, start - 1]
+            features[:, start + 1] = np.where(has_prev, prev_rows[:, start], 0)
+            features[:, start + 2] = np.where(has_prev2, prev2_rows[:, start + 1], 0)
+            features[:, start + 3] = np.where(has_next, next_rows[:, start + 2], 0)
+
+        #bag of word indices
+        d = self.num_direct_dimensions
+        features[:, d] = rows[:, 12]
+        features[:, d + 1] = np.where(has_prev, prev_rows[:, 13], self.start_indicators[0])
+        features[:, d + 2] = np.where(has_next, next_rows[:, 14], self.end_indicators[0])
+
+        features[:, d + 3] = pos[:, 0]
+        features[:, d + 4] = np.where(has_prev, prev_pos[:, 1], self.start_indicators[1])
+        features[:, d + 5] = np.where(has_next, next_pos[:, 2], self.end_indicators[1])
+
+        return features
 
     def featurize_oneInstance(self, tokens: List[str], pos_tags: List[str], idx):
 
@@ -273,16 +777,17 @@ class Featurizer():
         # 13 -> tf-idf of previous word
         # 14 -> tf-idf of next word
         # 15 -> bias
+        # 16 to 19 -> 7, 9, 10 and 11 for the first of prior_types, and so on for the others
 
         #the above features are referred to as the "direct features"
-        # and the below ones are the compressed features
+        # and the below ones are the compressed features, d = num_direct_dimensions
         
-        # 16 -> index of current term (indicator)
-        # 17 -> index of previous term (indicator)
-        # 18 -> index of next term (indicator)
-        # 19 -> index of current term (indicator)
-        # 20 -> index of previous term (indicator)
-        # 21 -> index of next term (indicator)
+        # d -> index of current term (indicator)
+        # d + 1 -> index of previous term (indicator)
+        # d + 2 -> index of next term (indicator)
+        # d + 3 -> index of current term (indicator)
+        # d + 4 -> index of previous term (indicator)
+        # d + 5 -> index of next term (indicator)
 
         #Therefore, dimensions of the feature is 11 + vocab_size*3 + 1
         # last one is bias
@@ -295,7 +800,7 @@ class Featurizer():
         pos_tag = pos_tags[idx]
 
         
-        feature = np.zeros(15 + 1 + 3 + 3)
+        feature = np.zeros(self.num_direct_dimensions + 3 + 3)
 
         #word pattern features
         feature[0] = int(i==0)
@@ -333,33 +838,45 @@ class Featurizer():
         #bias
         feature[15] = 1
 
+        #name priors of the other types
+        for start, tables, max_counts in zip(range(16, self.num_direct_dimensions, 4), self.type_name_dicts,
+                                             self.max_type_name_dicts):
+            name, oneBefore, twoBefore, oneAfter = tables
+            if token.lower() in name:
+                feature[start] = name[token.lower()]/ max_counts[0]
+            if i>=1 and tokens[i-1].lower() in oneBefore:
+                feature[start + 1] = oneBefore[tokens[i-1].lower()]/ max_counts[1]
+            if i>=2 and tokens[i-2].lower() in twoBefore:
+                feature[start + 2] = twoBefore[tokens[i-2].lower()]/ max_counts[2]
+            if i+1 < len(tokens) and tokens[i+1].lower() in oneAfter:
+                feature[start + 3] = oneAfter[tokens[i+1].lower()]/ max_counts[3]
+
         #bag of word indices
-        # feature[16:] = 16 + 3*self.vocab_size - 1#words not in vocab
+        d = self.num_direct_dimensions
 
-        if token.lower() in self.vocab_dict:
-            feature[16] = 16 + self.vocab_dict[token.lower()]
-        else:
-            feature[16] = 16 + self.vocab_size
+        feature[d] = self.word_indicators(token.lower())[0]
 
-        if i >= 1 and tokens[i-1].lower() in self.vocab_dict:
-            feature[17] = 16 + self.vocab_dict[tokens[i-1].lower()] + self.vocab_size + 1
+        if i >= 1:
+            feature[d + 1] = self.word_indicators(tokens[i-1].lower())[1]
         else:
-            feature[17] = 16 + 2*self.vocab_size + 1
+            feature[d + 1] = self.start_indicators[0]
 
-            
-        if i+1 < len(tokens) and tokens[i+1].lower() in self.vocab_dict:
-            feature[18] = 16 + self.vocab_dict[tokens[i+1].lower()] + 2*self.vocab_size + 2
+        if i+1 < len(tokens):
+            feature[d + 2] = self.word_indicators(tokens[i+1].lower())[2]
         else:
-            feature[18] = 16 + 3*self.vocab_size + 2
+            feature[d + 2] = self.end_indicators[0]
         
-        if pos_tag.lower() in self.pos_dict:
-            feature[19] = 16 + 3*self.vocab_size + 3 + self.pos_dict[pos_tag.lower()]
+        feature[d + 3] = self.pos_indicators(pos_tag)[0]
         
-        if i>=1 and pos_tags[i-1].lower() in self.pos_dict:
-            feature[20] = 16 + 3*self.vocab_size + 3 + self.pos_dict[pos_tags[i-1].lower()] + self.total_posTags
+        if i>=1:
+            feature[d + 4] = self.pos_indicators(pos_tags[i-1])[1]
+        else:
+            feature[d + 4] = self.start_indicators[1]
         
-        if i+1 < len(tokens) and pos_tags[i+1].lower() in self.pos_dict:
-            feature[21] = 16 + 3*self.vocab_size + 3 + self.pos_dict[pos_tags[i+1].lower()] + 2*self.total_posTags
+        if i+1 < len(tokens):
+            feature[d + 5] = self.pos_indicators(pos_tags[i+1])[2]
+        else:
+            feature[d + 5] = self.end_indicators[1]
 
         
         return feature
\ No newline at end of file
@@ -1,11 +1,28 @@
 # optimizers.py
 
 from abc import ABC, abstractmethod
-from collections import Counter
+from collections import Counter, deque
 import numpy as np
 from typing import List
 
 
+def sparse_gradient_arrays(gradient):
+    """
+    :param gradient: Counter mapping feature indices to gradient values, or a pair (indices, values) of numpy arrays
+    in which an index may appear several times
+    :return: (indices, values) numpy arrays with unique indices, the values of duplicate indices being summed
+    """
+    if isinstance(gradient, dict):
+        indices = np.fromiter(gradient.keys(), dtype=np.int64, count=len(gradient))
+        values = np.fromiter(gradient.values(), dtype=float, count=len(gradient))
+        return indices, values
+    indices, values = gradient
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    values = np.asarray(values, dtype=float).ravel()
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    return unique_indices, np.bincount(inverse, weights=values, minlength=len(unique_indices))
+
+
 class Optimizer(ABC):
     """
     Optimizer that aims to *maximize* a given function.
@@ -24,7 +41,10 @@ class Optimizer(ABC):
         return score
 
     @abstractmethod
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
+        """
+        :param gradient: Counter, or (indices, values) numpy arrays (see sparse_gradient_arrays)
+        """
         pass
 
     @abstractmethod
@@ -50,16 +70,17 @@ class SGDOptimizer(Optimizer):
         self.weights = init_weights
         self.alpha = alpha
 
-    def apply_gradient_update(self,  gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         """
         Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
         hyperparameters constant as the batch size is varied
-        :param gradient: Counter containing the gradient values (i.e., sparse representation of the gradient)
+        :param gradient: Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
         :param batch_size: how many examples the gradient was computed on
         :return: nothing, modifies weights in-place
         """
-        for i in gradient.keys():
-            self.weights[i] = self.weights[i] + self.alpha * gradient[i]
+        indices, values = sparse_gradient_arrays(gradient)
+        self.weights[indices] += self.alpha * values
 
     def access(self, i: int):
         """
@@ -80,17 +101,18 @@ class BatchSGDOptimizer(Optimizer):
         self.weights = init_weights
         self.alpha = alpha
 
-    def apply_gradient_update(self,  gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         """
         Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
         hyperparameters constant as the batch size is varied
-        :param gradient: Counter containing the gradient values (i.e., sparse representation of the gradient)
+        :param gradient: Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
         :param batch_size: how many examples the gradient was computed on
         :return: nothing, modifies weights in-place
         """
         batch_size_multiplier = 1.0 / batch_size
-        for i in gradient.keys():
-            self.weights[i] = self.weights[i] + self.alpha * gradient[i] * batch_size_multiplier
+        indices, values = sparse_gradient_arrays(gradient)
+        self.weights[indices] += self.alpha * values * batch_size_multiplier
 
     def access(self, i: int):
         """
@@ -131,36 +153,68 @@ class L1RegularizedAdagradTrainer(Optimizer):
         self.use_regularization = use_regularization
         self.approximate = approximate
         self.curr_iter = 0
-        self.last_iter_touched = [0 for i in range(0, self.weights.shape[0])]
+        self.last_iter_touched = np.zeros(self.weights.shape[0], dtype=np.int64)
         self.diag_Gt = np.zeros_like(self.weights, dtype=float)
 
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         """
         Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
         hyperparameters constant as the batch size is varied
-        :param gradient Counter containing the gradient values (i.e., sparse representation of the gradient)
+        :param gradient Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
         :param batch_size: how many examples the gradient was computed on
         :return: nothing, modifies weights in-place
         """
         batch_size_multiplier = 1.0 / batch_size
         self.curr_iter += 1
-        for i in gradient.keys():
-            xti = self.weights[i]
-            # N.B. We negate the gradient here because the Adagrad formulas are all for minimizing
-            # and we're trying to maximize, so think of it as minimizing the negative of the objective
-            # which has the opposite gradient
-            # See section 5.1 in http://www.jmlr.org/papers/volume12/duchi11a/duchi11a.pdf for more details
-            # eta is the step size, lambda is the regularization
-            gti = -gradient[i] * batch_size_multiplier
-            old_eta_over_Htii = self.eta / (1 + np.sqrt(self.diag_Gt[i]))
-            self.diag_Gt[i] += gti * gti
-            Htii = 1 + np.sqrt(self.diag_Gt[i])
-            eta_over_Htii = self.eta / Htii
-            new_xti = xti - eta_over_Htii * gti
-            # Apply the regularizer for every iteration since touched
-            iters_since_touched = self.curr_iter - self.last_iter_touched[i]
-            self.last_iter_touched[i] = self.curr_iter
-            self.weights[i] = np.sign(new_xti) * max(0, np.abs(new_xti) - self.lamb * eta_over_Htii - (iters_since_touched - 1) * self.lamb * old_eta_over_Htii)
+        i, values = sparse_gradient_arrays(gradient)
+        xti = self.weights[i]
+        # N.B. We negate the gradient here because the Adagrad formulas are all for minimizing
+        # and we're trying to maximize, so think of it as minimizing the negative of the objective
+        # which has the opposite gradient
+        # See section 5.1 in http://www.jmlr.org/papers/volume12/duchi11a/duchi11a.pdf for more details
+        # eta is the step size, lambda is the regularization
+        gti = -values * batch_size_multiplier
+        old_eta_over_Htii = self.eta / (1 + np.sqrt(self.diag_Gt[i]))
+        self.diag_Gt[i] += gti * gti
+        Htii = 1 + np.sqrt(self.diag_Gt[i])
+        eta_over_Htii = self.eta / Htii
+        new_xti = xti - eta_over_Htii * gti
+        # Apply the regularizer for every iteration since touched
+        iters_since_touched = self.curr_iter - self.last_iter_touched[i]
+        self.last_iter_touched[i] = self.curr_iter
+        self.weights[i] = np.sign(new_xti) * np.maximum(0, np.abs(new_xti) - self.lamb * eta_over_Htii - (iters_since_touched - 1) * self.lamb * old_eta_over_Htii)
+
+    def score(self, feats: List[int]):
+        """
+        :param feats: List[int] feature vector indices (i.e., sparse representation of a feature vector)
+        :return: floating-point score, after catching up the regularization of all the features at once
+        """
+        return float(np.sum(self.access_batch(feats)))
+
+    def access_batch(self, indices):
+        """
+        Vectorized access: applies the pending regularization to all the given weights at once (unless approximate),
+        with the same result as calling access on each of them
+        :param indices: numpy array (or list) of weight indices, possibly with duplicates
+        :return: numpy array of the values of those weights
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if not self.approximate:
+            self.catch_up(np.unique(indices[self.last_iter_touched[indices] != self.curr_iter]))
+        return self.weights[indices]
+
+    def catch_up(self, stale: np.ndarray):
+        """
+        Applies the regularization skipped since the last touch to the given weights
+        :param stale: numpy array of unique indices of weights not touched at the current iteration
+        """
+        xti = self.weights[stale]
+        Htii = 1 + np.sqrt(self.diag_Gt[stale])
+        eta_over_Htii = self.eta / Htii
+        iters_since_touched = self.curr_iter - self.last_iter_touched[stale]
+        self.last_iter_touched[stale] = self.curr_iter
+        self.weights[stale] = np.sign(xti) * np.maximum(0, np.abs(xti) - iters_since_touched * self.lamb * self.eta * eta_over_Htii)
 
     def access(self, i: int):
         """
@@ -178,11 +232,11 @@ class L1RegularizedAdagradTrainer(Optimizer):
 
     def get_final_weights(self):
         """
-        :return: a numpy array containing the final weight vector values -- manually calls access to force each weight to
-        have an up-to-date value.
+        :return: a numpy array containing the final weight vector values -- catches up every stale weight in one
+        vectorized update to force each weight to have an up-to-date value.
         """
-        for i in range(0, self.weights.shape[0]):
-            self.access(i)
+        if not self.approximate:
+            self.catch_up(np.nonzero(self.last_iter_touched != self.curr_iter)[0])
         return self.weights
 
 
@@ -196,18 +250,161 @@ class UnregularizedAdagradTrainer(Optimizer):
         self.eta = eta
         self.diag_Gt = np.zeros_like(self.weights, dtype=float)
 
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         batch_size_multiplier = 1.0 / batch_size
-        for i in gradient.keys():
-            xti = self.weights[i]
-            gti = -gradient[i] * batch_size_multiplier
-            self.diag_Gt[i] += gti * gti
-            Htii = 1 + np.sqrt(self.diag_Gt[i])
-            eta_over_Htii = self.eta / Htii
-            self.weights[i] = xti - eta_over_Htii * gti
+        i, values = sparse_gradient_arrays(gradient)
+        xti = self.weights[i]
+        gti = -values * batch_size_multiplier
+        self.diag_Gt[i] += gti * gti
+        Htii = 1 + np.sqrt(self.diag_Gt[i])
+        eta_over_Htii = self.eta / Htii
+        self.weights[i] = xti - eta_over_Htii * gti
 
     def access(self, i: int):
         return self.weights[i]
 
     def get_final_weights(self):
         return self.weights
+
+
+class FTRLProximalOptimizer(Optimizer):
+    """
+    FTRL-Proximal with per-coordinate learning rates and L1/L2 regularization. Unlike the lazily regularized Adagrad,
+    the weights are obtained in closed form from the accumulated gradients, and every weight whose accumulated gradient
+    is within l1 of zero is exactly 0, so the final weight vector of a huge indicator feature space is truly sparse.
+    Same interface as the Adagrad trainers.
+    See algorithm 1 of https://research.google.com/pubs/archive/41159.pdf for more details
+    """
+    def __init__(self, init_weights, alpha=0.1, beta=1.0, l1=1.0, l2=1.0):
+        """
+        :param init_weights: a numpy array of the correct dimension, usually initialized to 0. It is updated in place.
+        :param alpha: float step size of the per-coordinate learning rate alpha / (beta + sqrt(sum of squared gradients))
+        :param beta: float smoothing of the learning rate, 1.0 is usually fine
+        :param l1: float L1 regularization strength, larger values give sparser weights
+        :param l2: float L2 regularization strength
+        """
+        self.weights = init_weights
+        self.alpha = alpha
+        self.beta = beta
+        self.l1 = l1
+        self.l2 = l2
+        self.n = np.zeros_like(self.weights, dtype=float)
+        # accumulated gradients, set so that the closed form below gives back the initial weights
+        self.z = -self.weights * (self.beta / self.alpha + self.l2) - np.sign(self.weights) * self.l1
+
+    def apply_gradient_update(self, gradient, batch_size: int):
+        """
+        Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
+        hyperparameters constant as the batch size is varied
+        :param gradient Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
+        :param batch_size: how many examples the gradient was computed on
+        :return: nothing, modifies weights in-place
+        """
+        i, values = sparse_gradient_arrays(gradient)
+        # N.B. negated as in the Adagrad trainers since FTRL minimizes and we're trying to maximize
+        gti = -values * (1.0 / batch_size)
+        sigma = (np.sqrt(self.n[i] + gti * gti) - np.sqrt(self.n[i])) / self.alpha
+        self.z[i] += gti - sigma * self.weights[i]
+        self.n[i] += gti * gti
+        self.weights[i] = self.closed_form_weights(i)
+
+    def closed_form_weights(self, i):
+        """
+        :param i: numpy array of weight indices
+        :return: the weights minimizing the regularized objective given the accumulated gradients z and n
+        """
+        z = self.z[i]
+        weights = -(z - np.sign(z) * self.l1) / ((self.beta + np.sqrt(self.n[i])) / self.alpha + self.l2)
+        weights[np.abs(z) <= self.l1] = 0.0
+        return weights
+
+    def access(self, i: int):
+        return self.weights[i]
+
+    def get_final_weights(self):
+        return self.weights
+
+
+def lbfgs_minimize(objective, x0: np.ndarray, max_iters=100, history_size=10, tolerance=1e-6, scales=None):
+    """
+    Limited-memory BFGS for smooth full-batch objectives, with the two-loop recursion for the search direction and a
+    backtracking line search (Armijo condition). Unlike the optimizers above this one *minimizes*, and it needs the
+    value and the gradient of the whole objective at every evaluation.
+    See chapter 7.2 of Nocedal and Wright, Numerical Optimization, for more details
+    :param objective: function mapping a weight vector to (value, gradient)
+    :param x0: numpy array of initial weights
+    :param max_iters: maximum number of L-BFGS iterations
+    :param history_size: number of (step, gradient change) pairs kept to approximate the inverse Hessian
+    :param tolerance: stop when the last history_size iterations together decreased the objective by less than this
+    fraction of its value, or when the line search fails along the steepest descent direction
+    :param scales: optional positive scale of every weight; the minimization runs over x / scales, a diagonal
+    preconditioning which can speed up the convergence a lot on badly conditioned objectives
+    :return: the minimizing weights, the number of objective evaluations (i.e., passes over the data) and why it
+    stopped: 'converged', 'line search failed' or 'max_iters' (the weights have not converged)
+    """
+    scales = np.ones(len(x0)) if scales is None else np.asarray(scales, dtype=float)
+    x = np.array(x0, dtype=float) / scales
+    value, gradient = objective(x * scales)
+    gradient = gradient * scales
+    num_evaluations = 1
+    history = deque(maxlen=history_size)
+    recent_values = deque([value], maxlen=history_size + 1)
+    stop_reason = 'max_iters'
+
+    for iteration in range(max_iters):
+        # two-loop recursion: direction = -H.gradient
+        q = gradient.copy()
+        alphas = []
+        for s, y, rho in reversed(history):
+            alpha = rho * s.dot(q)
+            q -= alpha * y
+            alphas.append(alpha)
+        if len(history) > 0:
+            s, y, rho = history[-1]
+            q *= s.dot(y) / y.dot(y)
+        else:
+            q /= max(np.linalg.norm(gradient), 1.0)
+        for (s, y, rho), alpha in zip(history, reversed(alphas)):
+            beta = rho * y.dot(q)
+            q += (alpha - beta) * s
+        direction = -q
+        slope = gradient.dot(direction)
+        if slope >= 0:
+            # not a descent direction, fall back to steepest descent
+            history.clear()
+            direction = -gradient / max(np.linalg.norm(gradient), 1.0)
+            slope = gradient.dot(direction)
+
+        step = 1.0
+        for _ in range(30):
+            new_x = x + step * direction
+            new_value, new_gradient = objective(new_x * scales)
+            new_gradient = new_gradient * scales
+            num_evaluations += 1
+            if new_value <= value + 1e-4 * step * slope:
+                break
+            step *= 0.5
+        else:
+            # no sufficient decrease along the direction: keep x, and retry from steepest descent unless the
+            # direction already was the steepest one
+            if len(history) == 0:
+                stop_reason = 'line search failed'
+                break
+            history.clear()
+            continue
+
+        s = new_x - x
+        y = new_gradient - gradient
+        if s.dot(y) > 1e-10:
+            history.append((s, y, 1.0 / s.dot(y)))
+        x, value, gradient = new_x, new_value, new_gradient
+        recent_values.append(value)
+        # a single iteration can make little progress before faster ones, so the decrease is measured over a window
+        if len(recent_values) == recent_values.maxlen and recent_values[0] - value < tolerance * max(abs(value), 1.0):
+            stop_reason = 'converged'
+            break
+
+    if stop_reason == 'max_iters':
+        print("WARNING: lbfgs_minimize stopped after max_iters = %i iterations without converging" % max_iters)
+    return x * scales, num_evaluations, stop_reason
@@ -45,90 +45,122 @@ class CRF(nn.Module):
 
     def get_emssions(self, seq_x):
         '''
-        input of dims (seq_length, nb_labels, 14 indexes)
+        input of dims (seq_length, nb_labels, 14 indexes), or (batch_size, seq_length, nb_labels, 14 indexes) for a
+        padded minibatch
         output must be dimensions (batch_size, seq_len, nb_labels)
+        the potential of a label is the sum of the weights of its active indexes, computed for all the positions with
+        one embedding_bag; BOS and EOS get 0
         '''
-        seq_length = seq_x.shape[0]
-        nb_labels = seq_x.shape[1]
-        num_active_indexes  = seq_x.shape[2]
-
-        emmisions = []
-
-        for i, x in enumerate(seq_x):
-            ind2 = x.flatten()
-            ind1 = np.array([i//14 for i in range(len(ind2))])
-
-            indices = torch.from_numpy(np.stack((ind1, ind2)))
-            values = torch.ones(len(ind2))
-
-            features = torch.sparse.FloatTensor(indices = indices, values=values,\
-            size=torch.Size([self.nb_labels, self.num_features]))
-            potential = torch.sparse.mm(features, self.emmision_weights)
-            emmisions.append(potential.squeeze())
-            
-        emmisions = torch.stack(emmisions).unsqueeze(0)
+        seq_x = np.asarray(seq_x)
+        if seq_x.ndim == 3:
+            seq_x = seq_x[np.newaxis]
+        batch_size, seq_length, nb_labels, num_active_indexes = seq_x.shape
+
+        indexes = torch.from_numpy(seq_x.reshape(-1, num_active_indexes)).long()
+        potential = nn.functional.embedding_bag(indexes, self.emmision_weights, mode='sum')
+        emmisions = nn.functional.pad(potential.view(batch_size, seq_length, nb_labels), (0, self.nb_labels - nb_labels))
         return emmisions
 
-    def viterbi_decode(self, emissions):
-
+    def viterbi_decode(self, emissions, lengths=None):
+        """
+        Viterbi over a padded batch: every position is one (batch_size, nb_labels, nb_labels) broadcast max, the
+        backpointers go to one preallocated tensor and are followed for all the sentences at once. Sentences stop
+        updating their scores past their length.
+        :param emissions: (batch_size, seq_length, nb_labels) as returned by get_emssions
+        :param lengths: (batch_size) number of tokens of every sentence, all at least 1; None if none is padded
+        :return: (batch_size) best scores and the list of the best label ids of every sentence
+        """
         batch_size, seq_length, nb_labels = emissions.shape
+        if lengths is None:
+            lengths = torch.full((batch_size,), seq_length, dtype=torch.long)
         alphas = self.transitions[self.BOS_TAG_ID, :].unsqueeze(0) + emissions[:, 0]
-        backpointers = []
+        backpointers = torch.zeros((batch_size, seq_length, nb_labels), dtype=torch.long)
 
         for i in range(1, seq_length):
-            alpha_t = []
-            backpointers_t = []
-
-            for tag in range(nb_labels):
-
-                e_scores = emissions[:, i, tag]
-                e_scores = e_scores.unsqueeze(1)
-                t_scores = self.transitions[:, tag]
-                t_scores = t_scores.unsqueeze(0)
-                # print(e_scores)
-                # print(t_scores)
-                # exit(0)
-                scores = e_scores + t_scores + alphas
-                max_score, max_score_tag = torch.max(scores, dim=-1)
-                alpha_t.append(max_score)
-                backpointers_t.append(max_score_tag)
-
-            new_alphas = torch.stack(alpha_t).t()
-            alphas = new_alphas
-            backpointers.append(backpointers_t)
+            # scores[b, prev, cur]
+            scores = alphas.unsqueeze(2) + self.transitions.unsqueeze(0) + emissions[:, i].unsqueeze(1)
+            max_scores, backpointers[:, i] = torch.max(scores, dim=1)
+            alphas = torch.where((i < lengths).unsqueeze(1), max_scores, alphas)
 
         last_transition = self.transitions[:, self.EOS_TAG_ID]
         end_scores = alphas + last_transition.unsqueeze(0)
         max_final_scores, max_final_tags = torch.max(end_scores, dim=1)
 
-        # find the best sequence of labels for each sample in the batch
-        best_sequences = []
-        all_emm = torch.ones(emissions.shape[:2])
-        emission_lengths = all_emm.int().sum(dim=1)
-        for i in range(batch_size):
-            sample_length = emission_lengths[i].item()
-            sample_final_tag = max_final_tags[i].item()
-            sample_backpointers = backpointers[: sample_length - 1]
-
-            # follow the backpointers to build the sequence of labels
-            sample_path = self.find_best_path(i, sample_final_tag, sample_backpointers)
-            # add this path to the list of best sequences
-            best_sequences.append(sample_path)
-
+        # follow the backpointers of all the samples together, holding the tag of a sample until its last position
+        paths = torch.zeros((batch_size, seq_length), dtype=torch.long)
+        tags = max_final_tags
+        batch = torch.arange(batch_size)
+        for i in range(seq_length - 1, -1, -1):
+            paths[:, i] = tags
+            if i > 0:
+                tags = torch.where(i < lengths, backpointers[batch, i, tags], tags)
+        best_sequences = [paths[b, 0:lengths[b]].tolist() for b in range(batch_size)]
         return max_final_scores, best_sequences
 
-    def find_best_path(self, sample_id, best_tag, backpointers):
+    def decode_batch(self, xs):
+        """
+        Decodes many sentences as one padded batch
+        :param xs: the get_emssions input of every sentence, all non empty
+        :return: list of the best label ids of every sentence
+        """
+        lengths = [len(x) for x in xs]
+        first = np.asarray(xs[0])
+        padded = np.zeros((len(xs), max(lengths)) + first.shape[1:], dtype=first.dtype)
+        for i, x in enumerate(xs):
+            padded[i, 0:len(x)] = x
+        with torch.no_grad():
+            emissions = self.get_emssions(padded)
+            score, paths = self.viterbi_decode(emissions, torch.tensor(lengths))
+        return paths
+
+    def viterbi_decode_kbest(self, emissions, k):
+        """
+        List Viterbi: the k best tag sequences under the scores of viterbi_decode, without its BIO repair and never
+        passing through BOS or EOS. The k best partial paths ending in every label are kept as a
+        [batch_size, nb_labels, k] tensor, and every position picks the k best of the nb_labels * k extensions into
+        each label with one topk.
+        :return: scores [batch_size, k] and paths [batch_size, k, seq_length] label ids, best first
+        """
+        batch_size, seq_length, nb_labels = emissions.shape
+        pseudo_labels = (torch.arange(nb_labels) >= self.BOS_TAG_ID).view(1, nb_labels, 1)
+        alphas = torch.full((batch_size, nb_labels, k), float('-inf'))
+        alphas[:, :, 0] = self.transitions[self.BOS_TAG_ID, :].unsqueeze(0) + emissions[:, 0]
+        alphas = alphas.masked_fill(pseudo_labels, float('-inf'))
+        # backpointers[b, i, tag, rank] = prev_tag * k + prev_rank of the rank-th best path ending in tag at i
+        backpointers = torch.zeros((batch_size, seq_length, nb_labels, k), dtype=torch.long)
+
+        for i in range(1, seq_length):
+            scores = alphas.unsqueeze(3) + self.transitions.view(1, nb_labels, 1, nb_labels)
+            top_scores, top_indexes = torch.topk(scores.reshape(batch_size, nb_labels * k, nb_labels), k, dim=1)
+            alphas = top_scores.transpose(1, 2) + emissions[:, i].unsqueeze(2)
+            alphas = alphas.masked_fill(pseudo_labels, float('-inf'))
+            backpointers[:, i] = top_indexes.transpose(1, 2)
+
+        end_scores = alphas + self.transitions[:, self.EOS_TAG_ID].view(1, -1, 1)
+        best_scores, best_indexes = torch.topk(end_scores.reshape(batch_size, nb_labels * k), k, dim=1)
+        tags, ranks = best_indexes // k, best_indexes % k
+
+        paths = torch.zeros((batch_size, k, seq_length), dtype=torch.long)
+        batch = torch.arange(batch_size).unsqueeze(1)
+        for i in range(seq_length - 1, -1, -1):
+            paths[:, :, i] = tags
+            if i > 0:
+                pointers = backpointers[batch, i, tags, ranks]
+                tags, ranks = pointers // k, pointers % k
+        return best_scores, paths
 
-        best_path = [best_tag]
-        for backpointers_t in reversed(backpointers):
-            best_tag = backpointers_t[best_tag][sample_id].item()
-            best_path.insert(0, best_tag)
-        return best_path
-    
     def forward(self, x):
         emissions = self.get_emssions(x)
         score, path = self.viterbi_decode(emissions)
         return path
+
+    def kbest(self, x, k):
+        """
+        :return: the k best paths of x and their scores, see viterbi_decode_kbest
+        """
+        emissions = self.get_emssions(x)
+        scores, paths = self.viterbi_decode_kbest(emissions, k)
+        return paths[0].tolist(), scores[0].tolist()
     
     def loss(self, x, tags):
         """Compute the negative log-likelihood. See `log_likelihood` method."""
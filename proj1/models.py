@@ -8,6 +8,7 @@ from collections import Counter
 from typing import List
 import numpy as np
 import pickle
+import multiprocessing
 import os
 import torch
 import torch.optim as optim
@@ -73,100 +74,234 @@ class HmmNerModel(object):
         self.emission_log_probs = emission_log_probs
 
 
+    def save(self, path: str):
+        """
+        Writes the model to the directory path, one .npy file per array: the log probability matrices and the indexers
+        as utf-8 encoded strings in index order
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {'init_log_probs': self.init_log_probs,
+                  'transition_log_probs': self.transition_log_probs,
+                  'emission_log_probs': self.emission_log_probs,
+                  'tags': encode_strings([self.tag_indexer.get_object(i) for i in range(0, len(self.tag_indexer))]),
+                  'words': encode_strings([self.word_indexer.get_object(i) for i in range(0, len(self.word_indexer))])}
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), np.asarray(array))
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a model written by save. The emission matrix is memory mapped read only, so processes loading the same
+        model share its pages
+        """
+        indexers = []
+        for name in ('tags', 'words'):
+            indexer = Indexer()
+            for obj in decode_strings(np.load(os.path.join(path, name + '.npy'))):
+                indexer.add_and_get_index(obj)
+            indexers.append(indexer)
+        return cls(indexers[0], indexers[1], np.load(os.path.join(path, 'init_log_probs.npy')),
+                   np.load(os.path.join(path, 'transition_log_probs.npy')),
+                   np.load(os.path.join(path, 'emission_log_probs.npy'), mmap_mode='r'))
+
     def decode(self, sentence_tokens: List[Token]):
         """
         See BadNerModel for an example implementation
         :param sentence_tokens: List of the tokens in the sentence to tag
         :return: The LabeledSentence consisting of predictions over the sentence
         """
+        return self.decode_batch([sentence_tokens])[0]
 
-        N = len(self.init_log_probs)
-        T = len(sentence_tokens)
-        dp = np.zeros((N, T)) - np.inf #initialized to a low value as we have to find maximum
-        prev = np.zeros((N, T)) #backpointers
+    def word_ids(self, sentence_tokens: List[Token]) -> List[int]:
+        """
+        :return: the index of every word in the emission matrix, UNK for unknown words
+        """
+        unk_idx = self.word_indexer.index_of("UNK")
+        word_ids = [self.word_indexer.index_of(token.word) for token in sentence_tokens]
+        return [unk_idx if word_idx == -1 else word_idx for word_idx in word_ids]
 
-        #initialization 
-        for state_idx in range(N):
-            word_idx = self.word_indexer.index_of(sentence_tokens[0].word)
-            if(word_idx == -1):
-               word_idx = self.word_indexer.index_of("UNK")
-            dp[state_idx,0] = self.init_log_probs[state_idx] + self.emission_log_probs[state_idx, word_idx]
-        
-        #forward
+    def viterbi(self, word_ids: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """
+        Viterbi over a batch of sentences padded to a common length: at every position, the scores of all the
+        (sentence, previous state, state) triples are computed with one broadcast over transition_log_probs.
+        Sentences stop updating their scores past their length.
+        :param word_ids: [batch_size, max_len] emission matrix indices, padded with any valid index
+        :param lengths: [batch_size] number of tokens of every sentence, all at least 1
+        :return: [batch_size, max_len] best tag indices, 0 past the length of a sentence
+        """
+        B, T = word_ids.shape
+        emissions = self.emission_log_probs[:, word_ids].transpose(1, 2, 0) # [B, T, N]
+        N = emissions.shape[2]
+        batch = np.arange(B)
+
+        dp = self.init_log_probs + emissions[:, 0]
+        prev = np.zeros((B, T, N), dtype=int) #backpointers
         for t in range(1, T):
-            token = sentence_tokens[t]
-            word_idx = self.word_indexer.index_of(token.word)
-            if(word_idx == -1):
-               word_idx = self.word_indexer.index_of("UNK")
-               
-            for cur_state_idx in range(N):
-                tmp = dp[:, t-1] + self.transition_log_probs[:, cur_state_idx]
-                best_prev = tmp.argmax()
-                prev[cur_state_idx, t] = best_prev
-                dp[cur_state_idx, t] = tmp[best_prev] + self.emission_log_probs[cur_state_idx, word_idx]
-         
+            tmp = dp[:, :, np.newaxis] + self.transition_log_probs # [B, prev state, cur state]
+            prev[:, t] = tmp.argmax(axis=1)
+            scores = tmp.max(axis=1) + emissions[:, t]
+            dp = np.where((t < lengths)[:, np.newaxis], scores, dp)
+
         #backtracing
-        pred_tag_indexes = [] #will be stored in reverse order
-        temp_status = np.argmax(dp[:, -1])
-        pred_tag_indexes.append(temp_status)
-        
-        for t in range(T-1, 0, -1):
-           temp_status = prev[int(temp_status), t]
-           pred_tag_indexes.append(temp_status)
-        
-        pred_tag_indexes = pred_tag_indexes[::-1]
-        pred_tags = []
+        pred_tag_indexes = np.zeros((B, T), dtype=int)
+        state = dp.argmax(axis=1)
+        for t in range(T-1, -1, -1):
+            active = t < lengths
+            pred_tag_indexes[active, t] = state[active]
+            if t > 0:
+                state = np.where(active, prev[batch, t, state], state)
+        return pred_tag_indexes
+
+    def kbest_viterbi(self, word_ids: np.ndarray, lengths: np.ndarray, k: int):
+        """
+        List Viterbi over a padded batch, with the same inputs as viterbi. The k best partial paths ending in every
+        state are kept sorted in a [batch_size, num_tags, k] score array. The k best extensions into a state are a merge
+        of num_tags sorted lists, one per previous state, so they are taken in k steps, each an argmax over the heads
+        of the lists of all the (sentence, state) pairs at once. Ties go to the lowest previous state, so k = 1 is
+        exactly viterbi.
+        :return: tags [batch_size, k, max_len] tag indices (0 past the length of a sentence) and scores [batch_size, k]
+        log joint probabilities, best first; -inf scores mark ranks beyond the number of possible sequences
+        """
+        B, T = word_ids.shape
+        emissions = self.emission_log_probs[:, word_ids].transpose(1, 2, 0) # [B, T, N]
+        N = emissions.shape[2]
+        batch, states = np.arange(B)[:, np.newaxis], np.arange(N)[np.newaxis, :]
+        transitions = self.transition_log_probs.T # [cur state, prev state]
+
+        dp = np.full((B, N, k), -np.inf)
+        dp[:, :, 0] = self.init_log_probs + emissions[:, 0]
+        prev = np.zeros((B, T, N, k), dtype=int) #backpointers, prev state * k + rank of the extended path
+        for t in range(1, T):
+            heads = np.zeros((B, N, N), dtype=int) # [B, cur state, prev state] rank of the next path to extend
+            head_scores = dp[:, np.newaxis, :, 0] + transitions
+            scores = np.empty((B, N, k))
+            for rank in range(k):
+                best_prev = head_scores.argmax(axis=2) # [B, cur state]
+                scores[:, :, rank] = head_scores[batch, states, best_prev]
+                best_rank = np.minimum(heads[batch, states, best_prev], k-1)
+                prev[:, t, :, rank] = best_prev * k + best_rank
+                heads[batch, states, best_prev] = best_rank + 1
+                head_scores[batch, states, best_prev] = np.where(best_rank + 1 < k,
+                    dp[batch, best_prev, np.minimum(best_rank + 1, k-1)] + transitions[states, best_prev], -np.inf)
+            dp = np.where((t < lengths)[:, np.newaxis, np.newaxis], scores + emissions[:, t, :, np.newaxis], dp)
+
+        #backtracing
+        final = dp.reshape(B, N * k)
+        order = np.argsort(-final, axis=1, kind='stable')[:, 0:k]
+        scores = np.take_along_axis(final, order, axis=1)
+        state, rank = order // k, order % k
+        pred_tag_indexes = np.zeros((B, k, T), dtype=int)
+        for t in range(T-1, -1, -1):
+            active = (t < lengths)[:, np.newaxis]
+            pred_tag_indexes[:, :, t] = np.where(active, state, 0)
+            if t > 0:
+                pointer = prev[batch, t, state, rank]
+                state = np.where(active, pointer // k, state)
+                rank = np.where(active, pointer % k, rank)
+        return pred_tag_indexes, scores
+
+    def padded_batches(self, sentences_tokens: List[List[Token]], batch_size=256):
+        """
+        Groups the non empty sentences by similar lengths to limit padding
+        :return: generator of (indices of the sentences, [batch_size, max_len] padded word ids, [batch_size] lengths)
+        """
+        lengths = np.array([len(tokens) for tokens in sentences_tokens], dtype=int)
+        order = [i for i in np.argsort(lengths, kind='stable') if lengths[i] > 0]
+        for cursor in range(0, len(order), batch_size):
+            batch = order[cursor: cursor+batch_size]
+            word_ids = np.zeros((len(batch), lengths[batch].max()), dtype=int)
+            for row, i in enumerate(batch):
+                word_ids[row, 0:lengths[i]] = self.word_ids(sentences_tokens[i])
+            yield batch, word_ids, lengths[batch]
+
+    def decode_batch(self, sentences_tokens: List[List[Token]], batch_size=256) -> List[LabeledSentence]:
+        """
+        Decodes many sentences, batch_size at a time; sentences of similar lengths are batched together to limit padding
+        :param sentences_tokens: the token lists of the sentences to tag
+        :return: one LabeledSentence per sentence, in the same order
+        """
+        results = [LabeledSentence(tokens, []) for tokens in sentences_tokens]
+        for batch, word_ids, lengths in self.padded_batches(sentences_tokens, batch_size):
+            pred_tag_indexes = self.viterbi(word_ids, lengths)
+            for row, i in enumerate(batch):
+                pred_tags = [self.tag_indexer.get_object(tag_index) for tag_index in pred_tag_indexes[row, 0:lengths[row]].tolist()]
+                results[i] = LabeledSentence(sentences_tokens[i], chunks_from_bio_tag_seq(pred_tags))
+        return results
+
+    def decode_kbest(self, sentences_tokens: List[List[Token]], k=5, batch_size=256):
+        """
+        k best taggings of many sentences, batched as in decode_batch
+        :return: for every sentence, a list of up to k (LabeledSentence, log joint probability) pairs, best first
+        """
+        results = [[] for tokens in sentences_tokens]
+        for batch, word_ids, lengths in self.padded_batches(sentences_tokens, batch_size):
+            pred_tag_indexes, scores = self.kbest_viterbi(word_ids, lengths, k)
+            for row, i in enumerate(batch):
+                for rank in np.nonzero(np.isfinite(scores[row]))[0]:
+                    pred_tags = [self.tag_indexer.get_object(tag_index) for tag_index in pred_tag_indexes[row, rank, 0:lengths[row]].tolist()]
+                    results[i].append((LabeledSentence(sentences_tokens[i], chunks_from_bio_tag_seq(pred_tags)), float(scores[row, rank])))
+        return results
+
+    def forward_backward(self, word_ids: np.ndarray, lengths: np.ndarray):
+        """
+        Log-space forward-backward over a batch of sentences padded to a common length, with the same inputs as viterbi.
+        Every position sums over all the (sentence, previous state, state) triples at once with logsumexp.
+        :return: marginals [batch_size, max_len, num_tags] posterior probabilities of every tag at every position
+        (0 past the length of a sentence) and log_partition [batch_size] log probability of every sentence
+        """
+        B, T = word_ids.shape
+        emissions = self.emission_log_probs[:, word_ids].transpose(1, 2, 0) # [B, T, N]
+        N = emissions.shape[2]
+        valid = np.arange(T) < lengths[:, np.newaxis] # [B, T]
 
-        for tag_index in pred_tag_indexes:
-            pred_tags.append(self.tag_indexer.get_object(tag_index))
+        alpha = np.zeros((B, T, N))
+        alpha[:, 0] = self.init_log_probs + emissions[:, 0]
+        for t in range(1, T):
+            alpha[:, t] = logsumexp(alpha[:, t-1, :, np.newaxis] + self.transition_log_probs, axis=1) + emissions[:, t]
 
+        beta = np.zeros((B, T, N))
+        for t in range(T-2, -1, -1):
+            scores = logsumexp(self.transition_log_probs + (emissions[:, t+1] + beta[:, t+1])[:, np.newaxis, :], axis=2)
+            beta[:, t] = np.where(valid[:, t+1, np.newaxis], scores, 0)
 
-        assert len(pred_tags) == T
-        
+        log_partition = logsumexp(alpha[np.arange(B), lengths - 1], axis=1)
+        marginals = np.exp(alpha + beta - log_partition[:, np.newaxis, np.newaxis])
+        return np.where(valid[:, :, np.newaxis], marginals, 0), log_partition
+
+    def marginals_batch(self, sentences_tokens: List[List[Token]], batch_size=256) -> List[np.ndarray]:
+        """
+        Posterior tag marginals of many sentences, batched as in decode_batch
+        :return: one [len(sentence), num_tags] array per sentence, in the same order; columns follow tag_indexer
+        """
+        results = [np.zeros((0, len(self.tag_indexer))) for tokens in sentences_tokens]
+        for batch, word_ids, lengths in self.padded_batches(sentences_tokens, batch_size):
+            marginals, log_partition = self.forward_backward(word_ids, lengths)
+            for row, i in enumerate(batch):
+                results[i] = marginals[row, 0:lengths[row]]
+        return results
 
-        # raise Exception("IMPLEMENT ME")
-        return LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags))
 
+def logsumexp(a: np.ndarray, axis: int):
+    """
+    log(sum(exp(a))) along axis, computed stably by factoring out the maximum; -inf if all the terms are -inf
+    """
+    a_max = np.max(a, axis=axis, keepdims=True)
+    a_max = np.where(np.isfinite(a_max), a_max, 0)
+    return np.log(np.sum(np.exp(a - a_max), axis=axis)) + np.squeeze(a_max, axis=axis)
 
 
-def train_hmm_model(sentences: List[LabeledSentence]) -> HmmNerModel:
+def train_hmm_model(sentences: List[LabeledSentence], num_workers=1) -> HmmNerModel:
     """
     Uses maximum-likelihood estimation to read an HMM off of a corpus of sentences.
     Any word that only appears once in the corpus is replaced with UNK. A small amount
     of additive smoothing is applied.
-    :param sentences: training corpus of LabeledSentence objects
+    :param sentences: training corpus of LabeledSentence objects, or a CorpusStore
+    :param num_workers: number of processes counting shards of the corpus, see count_hmm_store
     :return: trained HmmNerModel
     """
-    # Index words and tags. We do this in advance so we know how big our
-    # matrices need to be.
-    tag_indexer = Indexer()
-    word_indexer = Indexer()
-    word_indexer.add_and_get_index("UNK")
-    word_counter = Counter()
-    for sentence in sentences:
-        for token in sentence.tokens:
-            word_counter[token.word] += 1.0
-    for sentence in sentences:
-        for token in sentence.tokens:
-            # If the word occurs fewer than two times, don't index it -- we'll treat it as UNK
-            get_word_index(word_indexer, word_counter, token.word)
-        for tag in sentence.get_bio_tags():
-            tag_indexer.add_and_get_index(tag)
-    # Count occurrences of initial tags, transitions, and emissions
-    # Apply additive smoothing to avoid log(0) / infinities / etc.
-    init_counts = np.zeros((len(tag_indexer)), dtype=float) + 0.0001
-    transition_counts = np.zeros((len(tag_indexer),len(tag_indexer)), dtype=float)  + 0.000000001
-    emission_counts = np.zeros((len(tag_indexer),len(word_indexer)), dtype=float)   + 0.0001
-    for sentence in sentences:
-        bio_tags = sentence.get_bio_tags()
-        for i in range(0, len(sentence)):
-            tag_idx = tag_indexer.add_and_get_index(bio_tags[i])
-            word_idx = get_word_index(word_indexer, word_counter, sentence.tokens[i].word)
-            emission_counts[tag_idx][word_idx] += 1.0
-            if i == 0:
-                init_counts[tag_idx] += 1.0
-            else:
-                transition_counts[tag_indexer.add_and_get_index(bio_tags[i-1])][tag_idx] += 1.0
+    # The words and tags are int encoded once, in order of first occurrence, and all the counting is done over the arrays
+    store = sentences if isinstance(sentences, CorpusStore) else CorpusStore.from_sentences(sentences)
+    tag_indexer, word_indexer, init_counts, transition_counts, emission_counts = count_hmm_store(store, num_workers)
     # Turn counts into probabilities for initial tags, transitions, and emissions. All
     # probabilities are stored as log probabilities
     print(repr(init_counts))
@@ -187,6 +322,192 @@ def train_hmm_model(sentences: List[LabeledSentence]) -> HmmNerModel:
     return HmmNerModel(tag_indexer, word_indexer, init_counts, transition_counts, emission_counts)
 
 
+def hmm_event_counts(tag_ids: np.ndarray, word_ids: np.ndarray, offsets: np.ndarray, num_tags: int, num_words: int):
+    """
+    Integer counts of the initial tags, transitions and (tag, word) emissions of a shard of sentences
+    :param tag_ids: [num_tokens] tag ids of the tokens of the shard
+    :param word_ids: [num_tokens] word ids of the tokens
+    :param offsets: offsets of the sentences of the shard in tag_ids, starting at 0
+    :return: init [num_tags], transitions [num_tags, num_tags] (prev, curr), emissions [num_tags, num_words] int64 arrays
+    """
+    tag_ids = np.asarray(tag_ids, dtype=np.int64)
+    word_ids = np.asarray(word_ids, dtype=np.int64)
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1][offsets[1:] > offsets[:-1]]
+    has_prev = np.ones(len(tag_ids), dtype=bool)
+    has_prev[starts] = False
+    positions = np.nonzero(has_prev)[0]
+
+    init = np.bincount(tag_ids[starts], minlength=num_tags)
+    transitions = np.bincount(tag_ids[positions - 1] * num_tags + tag_ids[positions], minlength=num_tags * num_tags)
+    emissions = np.bincount(tag_ids * num_words + word_ids, minlength=num_tags * num_words)
+    return init, transitions.reshape(num_tags, num_tags), emissions.reshape(num_tags, num_words)
+
+
+def count_hmm_store(store: CorpusStore, num_workers=1):
+    """
+    The counts of train_hmm_model, computed with bincount over the id arrays of a CorpusStore. With several workers,
+    the sentences are split into contiguous shards counted in parallel processes, and the integer count matrices of
+    the shards are summed, so the result does not depend on num_workers.
+    :return: tag_indexer, word_indexer and the smoothed init_counts, transition_counts, emission_counts
+    """
+    tag_indexer = store.tag_indexer
+    num_tags, num_words = len(store.tag_indexer), len(store.word_indexer)
+    offsets = np.asarray(store.offsets)
+
+    if num_workers <= 1:
+        init, transitions, emissions = hmm_event_counts(store.tag_ids, store.word_ids, offsets, num_tags, num_words)
+    else:
+        bounds = np.searchsorted(offsets, np.linspace(0, offsets[-1], num_workers + 1)[1:-1])
+        bounds = np.unique(np.concatenate(([0], bounds, [len(offsets) - 1])))
+        shards = [(np.asarray(store.tag_ids[offsets[a]:offsets[b]]), np.asarray(store.word_ids[offsets[a]:offsets[b]]),
+                   offsets[a:b + 1] - offsets[a], num_tags, num_words) for a, b in zip(bounds[:-1], bounds[1:])]
+        with multiprocessing.Pool(num_workers) as pool:
+            shard_counts = pool.starmap(hmm_event_counts, shards)
+        init, transitions, emissions = (sum(counts) for counts in zip(*shard_counts))
+
+    # Words occurring fewer than two times are mapped to UNK, as in get_word_index, and their columns merged
+    word_indexer = Indexer()
+    word_indexer.add_and_get_index("UNK")
+    word_counts = emissions.sum(axis=0)
+    hmm_word_ids = np.zeros(num_words, dtype=int)
+    for store_id, word in enumerate(store.strings('word')):
+        if word_counts[store_id] >= 2:
+            hmm_word_ids[store_id] = word_indexer.add_and_get_index(word)
+    hmm_emissions = np.zeros((len(word_indexer), num_tags), dtype=np.int64)
+    np.add.at(hmm_emissions, hmm_word_ids, emissions.T)
+
+    # Apply additive smoothing to avoid log(0) / infinities / etc.
+    init_counts = init + 0.0001
+    transition_counts = transitions + 0.000000001
+    emission_counts = hmm_emissions.T + 0.0001
+    return tag_indexer, word_indexer, init_counts, transition_counts, emission_counts
+
+
+class IncrementalHmmNerModel(HmmNerModel):
+    """
+    HmmNerModel that keeps the raw integer counts of train_hmm_model and is updated in place with batches of new
+    sentences. The log probabilities are renormalized lazily, on the first access after an update, and only for the
+    rows whose counts changed. The emission matrices grow their word columns by doubling, so adding words is amortized
+    constant time. The probabilities match train_hmm_model on the concatenation of all the batches: words seen once so
+    far are counted under UNK and remembered in pending_words, and move to their own column when seen again.
+
+    Attributes:
+        tag_indexer: fixed Indexer of the BIO tags
+        word_indexer: Indexer of the words with their own emission column, UNK first
+        init_counts: [num_tags] int64 counts of the initial tags
+        transition_counts: [num_tags, num_tags] int64 counts (prev, curr)
+        emission_counts: [num_tags, capacity] int64 counts (tag, word), the first len(word_indexer) columns are in use
+        pending_words: dict word -> tag id of the words seen exactly once
+    """
+    def __init__(self, tag_indexer: Indexer, capacity=1024):
+        num_tags = len(tag_indexer)
+        self.tag_indexer = tag_indexer
+        self.word_indexer = Indexer()
+        self.word_indexer.add_and_get_index("UNK")
+        self.init_counts = np.zeros(num_tags, dtype=np.int64)
+        self.transition_counts = np.zeros((num_tags, num_tags), dtype=np.int64)
+        self.emission_counts = np.zeros((num_tags, capacity), dtype=np.int64)
+        self.pending_words = {}
+        self._init_log_probs = np.zeros(num_tags)
+        self._transition_log_probs = np.zeros((num_tags, num_tags))
+        self._emission_log_probs = np.zeros((num_tags, capacity))
+        self._dirty_rows = np.ones(num_tags, dtype=bool)
+        self._dirty_transitions = True
+        self._normalized_words = 0
+
+    @property
+    def init_log_probs(self):
+        self._renormalize()
+        return self._init_log_probs
+
+    @property
+    def transition_log_probs(self):
+        self._renormalize()
+        return self._transition_log_probs
+
+    @property
+    def emission_log_probs(self):
+        """
+        [num_tags, num_words] view of the in-use columns
+        """
+        self._renormalize()
+        return self._emission_log_probs[:, 0:len(self.word_indexer)]
+
+    def update(self, sentences: List[LabeledSentence]):
+        """
+        Adds the counts of a batch of sentences; every tag must already be in tag_indexer
+        :param sentences: LabeledSentence objects, or a CorpusStore
+        :return: self
+        """
+        store = sentences if isinstance(sentences, CorpusStore) else CorpusStore.from_sentences(sentences)
+        num_tags = len(self.tag_indexer)
+        tag_map = np.array([self.tag_indexer.index_of(tag) for tag in store.strings('tag')], dtype=np.int64)
+        if (tag_map == -1).any():
+            raise ValueError("Unknown tags in update: %s" % [tag for tag in store.strings('tag') if not self.tag_indexer.contains(tag)])
+        init, transitions, emissions = hmm_event_counts(tag_map[np.asarray(store.tag_ids)], store.word_ids,
+                                                        store.offsets, num_tags, len(store.word_indexer))
+
+        # Column of every word of the batch: words seen once in total stay under UNK until they are seen again
+        batch_word_counts = emissions.sum(axis=0)
+        columns = np.zeros(len(store.word_indexer), dtype=np.int64)
+        promoted = []
+        for store_id, word in enumerate(store.strings('word')):
+            word_idx = self.word_indexer.index_of(word)
+            if word_idx == -1:
+                if word in self.pending_words or batch_word_counts[store_id] >= 2:
+                    word_idx = self.word_indexer.add_and_get_index(word)
+                    if word in self.pending_words:
+                        promoted.append((self.pending_words.pop(word), word_idx))
+                else:
+                    self.pending_words[word] = int(emissions[:, store_id].argmax())
+                    word_idx = 0
+            columns[store_id] = word_idx
+
+        num_words = len(self.word_indexer)
+        if num_words > self.emission_counts.shape[1]:
+            self._grow(max(2 * self.emission_counts.shape[1], num_words))
+        np.add.at(self.emission_counts.T, columns, emissions.T)
+        for tag_idx, word_idx in promoted:
+            self.emission_counts[tag_idx, 0] -= 1
+            self.emission_counts[tag_idx, word_idx] += 1
+        self.init_counts += init
+        self.transition_counts += transitions
+
+        # the smoothing mass of a new column changes the normalizer of every row
+        if num_words > self._normalized_words:
+            self._dirty_rows[:] = True
+        else:
+            self._dirty_rows |= emissions.sum(axis=1) > 0
+        self._dirty_transitions = True
+        return self
+
+    def _grow(self, capacity: int):
+        for name in ('emission_counts', '_emission_log_probs'):
+            old = getattr(self, name)
+            new = np.zeros((old.shape[0], capacity), dtype=old.dtype)
+            new[:, 0:old.shape[1]] = old
+            setattr(self, name, new)
+
+    def _renormalize(self):
+        """
+        Recomputes the log probabilities from the counts, with the smoothing of count_hmm_store, for the dirty rows
+        """
+        if self._dirty_transitions:
+            init_counts = self.init_counts + 0.0001
+            self._init_log_probs = np.log(init_counts / init_counts.sum())
+            transition_counts = self.transition_counts + 0.000000001
+            self._transition_log_probs = np.log(transition_counts / transition_counts.sum(axis=1)[:, np.newaxis])
+            self._dirty_transitions = False
+        rows = np.nonzero(self._dirty_rows)[0]
+        if len(rows) > 0:
+            num_words = len(self.word_indexer)
+            emission_counts = self.emission_counts[rows, 0:num_words] + 0.0001
+            self._emission_log_probs[rows, 0:num_words] = np.log(emission_counts / emission_counts.sum(axis=1)[:, np.newaxis])
+            self._dirty_rows[:] = False
+            self._normalized_words = num_words
+
+
 def get_word_index(word_indexer: Indexer, word_counter: Counter, word: str) -> int:
     """
     Retrieves a word's index based on its count. If the word occurs only once, treat it as an "UNK" token
@@ -215,6 +536,48 @@ class CrfNerModel(object):
             self.embedder = torch.load("simple.embedder")
 
     def decode(self, sentence_tokens):
+        tag_indexer = self.tag_indexer
+        all_features = self.sentence_features(sentence_tokens)
+        best_tags = self.model(all_features)
+
+        
+        
+        pred_tags = []
+
+        for tag in best_tags:
+            pred_tags.append(tag_indexer.get_object(tag))
+        
+        return LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags))
+
+    def decode_batch(self, sentences_tokens, batch_size=64):
+        """
+        Decodes many sentences, batch_size at a time through CRF.decode_batch; sentences of similar lengths are batched
+        together to limit padding
+        :return: one LabeledSentence per sentence, in the same order
+        """
+        results = [LabeledSentence(tokens, []) for tokens in sentences_tokens]
+        lengths = np.array([len(tokens) for tokens in sentences_tokens], dtype=int)
+        order = [i for i in np.argsort(lengths, kind='stable') if lengths[i] > 0]
+        for cursor in range(0, len(order), batch_size):
+            batch = order[cursor: cursor+batch_size]
+            paths = self.model.decode_batch([self.sentence_features(sentences_tokens[i]) for i in batch])
+            for i, best_tags in zip(batch, paths):
+                pred_tags = [self.tag_indexer.get_object(tag) for tag in best_tags]
+                results[i] = LabeledSentence(sentences_tokens[i], chunks_from_bio_tag_seq(pred_tags))
+        return results
+
+    def decode_kbest(self, sentence_tokens, k=5):
+        """
+        :return: list of the k best (LabeledSentence, score) pairs of the CRF, best first
+        """
+        paths, scores = self.model.kbest(self.sentence_features(sentence_tokens), k)
+        return [(LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq([self.tag_indexer.get_object(tag) for tag in path])), score)
+                for path, score in zip(paths, scores) if score != float('-inf')]
+
+    def sentence_features(self, sentence_tokens):
+        """
+        :return: the emission feature indices of every (word, tag) of the sentence, or their embeddings, as the CRF reads them
+        """
         tag_indexer = self.tag_indexer
         feature_indexer = self.feature_indexer
 
@@ -232,17 +595,7 @@ class CrfNerModel(object):
         
         if self.use_embedded:
             all_features = self.get_embedding(all_features, feature_indexer)
-  
-        best_tags = self.model(all_features)
-
-        
-        
-        pred_tags = []
-
-        for tag in best_tags:
-            pred_tags.append(tag_indexer.get_object(tag))
-        
-        return LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags))
+        return all_features
             
     def get_embedding(self, all_indices, feature_indexer):
 
@@ -263,12 +616,15 @@ class CrfNerModel(object):
         
         return embedded_x
 
-# Trains a CrfNerModel on the given corpus of sentences.
+# Trains a CrfNerModel on the given corpus of sentences, or on a CorpusStore: the gold tags are then read from its
+# tag ids, and the sentences are only rebuilt if the emission features have to be extracted.
 def train_crf_model(sentences):
-    tag_indexer = Indexer()
-    for sentence in sentences:
-        for tag in sentence.get_bio_tags():
-            tag_indexer.add_and_get_index(tag)
+    if isinstance(sentences, CorpusStore):
+        store = sentences
+        sentences = None
+    else:
+        store = CorpusStore.from_sentences(sentences)
+    tag_indexer = store.tag_indexer
     
 
     use_embedded = False
@@ -283,6 +639,8 @@ def train_crf_model(sentences):
 
     if not os.path.isfile(feature_indexer_file) or not os.path.isfile(feature_cache_file):
         print("Extracting features")
+        if sentences is None:
+            sentences = store.to_sentences()
         feature_indexer = Indexer()
         feature_cache = [[[[] for k in range(0, len(tag_indexer))] for j in range(0, len(sentences[i]))] for i in range(0, len(sentences))]
         for sentence_idx in range(0, len(sentences)):
@@ -311,7 +669,8 @@ def train_crf_model(sentences):
             crf_model = CRF(num_features = 300, nb_labels = len(tag_indexer))
 
         crf_model = torch.load("model_crf_nl.crf")
-        sentences, feature_cache = shuffle_list(sentences, feature_cache)
+        order = list(range(0, len(feature_cache)))
+        shuffle(order)
 
         transmission_optimizer = optim.Adam([crf_model.transitions], lr=lr)
         emmision_optimizer = optim.Adam([crf_model.emmision_weights, crf_model.emmision_weights2], lr=lr)
@@ -319,13 +678,10 @@ def train_crf_model(sentences):
         for epoch in range(num_epochs):
             total_loss = 0.0
             total_count = 0.0
-            for sentence_idx in range(len(feature_cache)):
-                sentence = sentences[sentence_idx]
-                true_tags = []
-                for tag in sentence.get_bio_tags():
-                    true_tags.append(tag_indexer.index_of(tag))
+            for count, sentence_idx in enumerate(order):
+                true_tags = np.asarray(store.tag_ids[store.offsets[sentence_idx]:store.offsets[sentence_idx+1]], dtype=int)
                 x = np.array(feature_cache[sentence_idx])
-                true_tags  = np.expand_dims(np.array(true_tags), axis=0)
+                true_tags  = np.expand_dims(true_tags, axis=0)
 
                 crf_model.zero_grad()
                 loss = crf_model.loss(x, true_tags)
@@ -336,8 +692,8 @@ def train_crf_model(sentences):
                 transmission_optimizer.step()
                 emmision_optimizer.step()
 
-                if(sentence_idx%100 == 0):
-                    print("epoch {} {}/{} done loss {}".format(epoch, sentence_idx, len(feature_cache), total_loss/total_count))
+                if(count%100 == 0):
+                    print("epoch {} {}/{} done loss {}".format(epoch, count, len(feature_cache), total_loss/total_count))
 
                 # if(sentence_idx == 100):
                 #     break
@@ -1,6 +1,7 @@
 # ner.py
 
 import argparse
+import os
 import sys
 import time
 from nerdata import *
@@ -18,10 +19,13 @@ def _parse_args():
     """
     parser = argparse.ArgumentParser(description='trainer.py')
     parser.add_argument('--model', type=str, default='BAD', help='model to run (BAD, HMM, CRF)')
-    parser.add_argument('--train_path', type=str, default='data/eng.train', help='path to train set (you should not need to modify)')
+    parser.add_argument('--train_path', type=str, default='data/eng.train', help='path to train set, a CoNLL file or a directory converted by nerdata.py (you should not need to modify)')
     parser.add_argument('--dev_path', type=str, default='data/eng.testa', help='path to dev set (you should not need to modify)')
     parser.add_argument('--blind_test_path', type=str, default='data/eng.testb.blind', help='path to blind test set (you should not need to modify)')
     parser.add_argument('--test_output_path', type=str, default='eng.testb.out', help='output path for test predictions')
+    parser.add_argument('--save_model', type=str, default=None, help='directory to save the trained HMM to')
+    parser.add_argument('--load_model', type=str, default=None, help='directory of a saved HMM to decode with instead of training one')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of processes counting the HMM parameters')
     parser.add_argument('--no_run_on_test', dest='run_on_test', default=True, action='store_false', help='skip printing output on the test set')
     args = parser.parse_args()
     return args
@@ -74,7 +78,14 @@ if __name__ == '__main__':
     args = _parse_args()
     print(args)
     # Load the training and test data
-    train = read_data(args.train_path)
+    if args.model == "HMM" and args.load_model is not None:
+        # nothing to train
+        train = None
+    elif os.path.isdir(args.train_path) and args.model in ("HMM", "CRF"):
+        # the HMM and CRF are trained directly from the id arrays of a CorpusStore
+        train = CorpusStore.load(args.train_path)
+    else:
+        train = read_data(args.train_path)
     dev = read_data(args.dev_path)
     # Here's a few sentences...
     print("Examples of sentences:")
@@ -88,22 +99,23 @@ if __name__ == '__main__':
         bad_model = train_bad_ner_model(train)
         dev_decoded = [bad_model.decode(test_ex.tokens) for test_ex in dev]
     elif system_to_run == "HMM":
-        hmm_model = train_hmm_model(train)
-        dev_decoded = [hmm_model.decode(test_ex.tokens) for test_ex in dev]
+        if args.load_model is not None:
+            hmm_model = HmmNerModel.load(args.load_model)
+        else:
+            hmm_model = train_hmm_model(train, args.num_workers)
+        if args.save_model is not None:
+            hmm_model.save(args.save_model)
+        dev_decoded = hmm_model.decode_batch([test_ex.tokens for test_ex in dev])
     elif system_to_run == "CRF":
         crf_model = train_crf_model(train)
         print("Data reading and training took %f seconds" % (time.time() - start_time))
-        dev_decoded = []
-
-        for i, test_ex in enumerate(dev):
-            dev_decoded.append(crf_model.decode(test_ex.tokens))
-            print("{} / {} completed".format(i, len(dev)))
+        dev_decoded = crf_model.decode_batch([test_ex.tokens for test_ex in dev])
         if args.run_on_test:
             print("Running on test")
             test = read_data(args.blind_test_path)
-            test_decoded = [crf_model.decode(test_ex.tokens) for test_ex in test]
+            test_decoded = crf_model.decode_batch([test_ex.tokens for test_ex in test])
             print_output(test_decoded, args.test_output_path)
     else:
         raise Exception("Pass in either BAD, HMM, or CRF to run the appropriate system")
     # Print the evaluation statistics
-    print_evaluation(dev, dev_decoded)
+    print_evaluation_by_type(dev, dev_decoded)
@@ -1,6 +1,13 @@
 # nerdata.py
 
-from typing import List
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import numpy as np
+from typing import Iterable, Iterator, List
+from utils import Indexer
 
 class Token:
     """
@@ -11,7 +18,11 @@ class Token:
         pos: string part-of-speech
         chunk: string representation of the syntactic chunk (e.g., I-NP). These can be useful
         features but you don't need to use them.
+    Tokens are not modified once built: the readers share one instance between all the occurrences of the same
+    (word, POS, chunk), and __slots__ avoids a dict per instance.
     """
+    __slots__ = ('word', 'pos', 'chunk')
+
     def __init__(self, word: str, pos: str, chunk: str):
         self.word = word
         self.pos = pos
@@ -35,6 +46,8 @@ class Chunk:
         end_idx:
         label: str
     """
+    __slots__ = ('start_idx', 'end_idx', 'label')
+
     def __init__(self, start_idx: int, end_idx: int, label: str):
         self.start_idx = start_idx
         self.end_idx = end_idx
@@ -69,11 +82,18 @@ class LabeledSentence:
         chunks: list[Chunk]
         bio_tags: list[str]
     """
-    def __init__(self, tokens: List[Token], chunks: List[Chunk]):
+    __slots__ = ('tokens', 'chunks', 'bio_tags')
+
+    def __init__(self, tokens: List[Token], chunks: List[Chunk], bio_tags=None):
+        """
+        :param bio_tags: the BIO tags of chunks if they are already known, i.e. what bio_tags_from_chunks returns
+        """
         self.tokens = tokens
         self.chunks = chunks
         if chunks is None:
             self.bio_tags = None
+        elif bio_tags is not None:
+            self.bio_tags = bio_tags
         else:
             self.bio_tags = bio_tags_from_chunks(self.chunks, len(self.tokens))
 
@@ -133,7 +153,7 @@ def chunks_from_bio_tag_seq(bio_tags: List[str]) -> List[Chunk]:
     curr_tok_label = ""
     for idx, tag in enumerate(bio_tags):
         if isB(tag):
-            label = get_tag_label(tag)
+            label = sys.intern(get_tag_label(tag))
             if curr_tok_label != "":
                 chunks.append(Chunk(curr_tok_start, idx, curr_tok_label))
             curr_tok_label = label
@@ -165,39 +185,350 @@ def bio_tags_from_chunks(chunks: List[Chunk], sent_len: int) -> List[str]:
         matching_chunks = list(filter(lambda chunk: chunk.start_idx <= i and i < chunk.end_idx, chunks))
         if len(matching_chunks) > 0:
             if i == matching_chunks[0].start_idx:
-                tags.append("B-" + matching_chunks[0].label)
+                tags.append(sys.intern("B-" + matching_chunks[0].label))
             else:
-                tags.append("I-" + matching_chunks[0].label)
+                tags.append(sys.intern("I-" + matching_chunks[0].label))
         else:
             tags.append("O")
     return tags
 
 
-def read_data(file: str) -> List[LabeledSentence]:
+class BioTagScheme(object):
+    """
+    Per tag id properties of a list of BIO tags (e.g. the objects of a tag Indexer), used to extract the chunks of
+    tag id arrays covering a whole corpus at once, with the same rules as chunks_from_bio_tag_seq: a chunk starts at
+    every B tag and ends at the next B or O tag (any tag that is neither B nor I counts as O) or at the end of the
+    sentence. I tags never start or end a chunk.
+
+    Attributes:
+        tags: the BIO tag of every tag id
+        labels: the chunk labels (e.g. PER) of the tags, in order of first occurrence
+        label_ids: [num_tags] index in labels of the label of every tag, -1 for O
+        is_B: [num_tags] whether every tag is a B tag
+        is_I: [num_tags] whether every tag is an I tag
+    """
+    def __init__(self, tags: List[str]):
+        self.tags = list(tags)
+        self.labels = []
+        for tag in self.tags:
+            if (isB(tag) or isI(tag)) and get_tag_label(tag) not in self.labels:
+                self.labels.append(get_tag_label(tag))
+        self.label_ids = np.array([self.labels.index(get_tag_label(tag)) if isB(tag) or isI(tag) else -1
+                                   for tag in self.tags], dtype=np.int64)
+        self.is_B = np.array([isB(tag) for tag in self.tags], dtype=bool)
+        self.is_I = np.array([isI(tag) for tag in self.tags], dtype=bool)
+
+    @classmethod
+    def from_indexer(cls, tag_indexer: Indexer):
+        return cls([tag_indexer.get_object(i) for i in range(0, len(tag_indexer))])
+
+    def chunk_arrays(self, tag_ids: np.ndarray, offsets: np.ndarray):
+        """
+        Integer counterpart of chunks_from_bio_tag_seq over all the sentences of a corpus
+        :param tag_ids: [num_tokens] tag ids of the tokens, sentence after sentence
+        :param offsets: [num_sentences + 1] offsets of the sentences in tag_ids
+        :return: starts, ends, label_ids: one entry per chunk in order, starts and ends being positions in tag_ids
+        (semi-inclusive, so the chunk covers starts[i]:ends[i])
+        """
+        tag_ids = np.asarray(tag_ids)
+        starts = np.nonzero(self.is_B[tag_ids])[0]
+        boundaries = np.union1d(np.nonzero(~self.is_I[tag_ids])[0], np.asarray(offsets[1:]))
+        ends = boundaries[np.searchsorted(boundaries, starts, side='right')]
+        return starts, ends, self.label_ids[tag_ids[starts]]
+
+    def tag_ids_from_chunk_arrays(self, starts: np.ndarray, ends: np.ndarray, label_ids: np.ndarray, num_tokens: int):
+        """
+        Integer counterpart of bio_tags_from_chunks: the B tag at the start of every chunk, I tags for the rest of it and
+        O elsewhere. The O tag and the B and I tags of the labels of the chunks must be in tags.
+        :return: [num_tokens] tag ids
+        """
+        b_ids = np.array([self.tags.index("B-" + label) if "B-" + label in self.tags else -1 for label in self.labels])
+        i_ids = np.array([self.tags.index("I-" + label) if "I-" + label in self.tags else -1 for label in self.labels])
+        tag_ids = np.full(num_tokens, self.tags.index("O"), dtype=np.int64)
+        lengths = ends - starts
+        inside = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        tag_ids[inside] = np.repeat(i_ids[label_ids], lengths)
+        tag_ids[starts] = b_ids[label_ids]
+        return tag_ids
+
+
+def iter_data(file: str) -> Iterator[LabeledSentence]:
     """
-    Reads a dataset in the CoNLL format from a file
+    Reads a dataset in the CoNLL format from a file, yielding the sentences as they are parsed
     The format is one token per line:
     [word] [POS] [syntactic chunk] *potential junk column* [NER tag]
     One blank line appears after each sentence
     :param file: string filename to read
-    :return: list[LabeledSentence]
+    :return: generator of LabeledSentence
+    """
+    with open(file) as f:
+        yield from parse_lines(f)
+
+
+def parse_lines(lines: Iterable[str]) -> Iterator[LabeledSentence]:
     """
-    f = open(file)
-    sentences = []
+    Parses CoNLL lines into sentences, see iter_data
+    """
+    shared_tokens = {}
     curr_tokens = []
     curr_bio_tags = []
-    for line in f:
+    for line in lines:
         stripped = line.strip()
         if stripped != "":
             fields = stripped.split(" ")
             if len(fields) == 4 or len(fields) == 5:
-                curr_tokens.append(Token(fields[0], fields[1], fields[2]))
-                curr_bio_tags.append(fields[-1])
+                key = (fields[0], fields[1], fields[2])
+                if key not in shared_tokens:
+                    shared_tokens[key] = Token(sys.intern(fields[0]), sys.intern(fields[1]), sys.intern(fields[2]))
+                curr_tokens.append(shared_tokens[key])
+                curr_bio_tags.append(sys.intern(fields[-1]))
         elif stripped == "" and len(curr_tokens) > 0:
-            sentences.append(LabeledSentence(curr_tokens, chunks_from_bio_tag_seq(curr_bio_tags)))
+            yield LabeledSentence(curr_tokens, chunks_from_bio_tag_seq(curr_bio_tags))
             curr_tokens = []
             curr_bio_tags = []
-    return sentences
+
+
+def shard_boundaries(file: str, num_shards: int) -> List[int]:
+    """
+    Splits a CoNLL file into at most num_shards byte ranges of similar sizes, each ending just after a blank line, so
+    that no sentence spans two ranges
+    :return: increasing byte offsets, from 0 to the size of the file
+    """
+    size = os.path.getsize(file)
+    boundaries = [0]
+    with open(file, 'rb') as f:
+        for shard in range(1, num_shards):
+            target = max(size * shard // num_shards, boundaries[-1])
+            f.seek(target)
+            if target > 0:
+                f.readline()  # skip to the start of the next line
+            for line in iter(f.readline, b''):
+                if line.decode('utf-8', errors='replace').strip() == "":
+                    break
+            if f.tell() > boundaries[-1] and f.tell() < size:
+                boundaries.append(f.tell())
+    boundaries.append(size)
+    return boundaries
+
+
+def _read_shard(file: str, start: int, end: int):
+    with open(file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # decoded with the default encoding and newline handling of open(file), as iter_data does; returned as the arrays
+    # of a CorpusStore, which are much cheaper to send back than the sentences
+    return CorpusStore.from_sentences(parse_lines(io.TextIOWrapper(io.BytesIO(data)))).to_arrays()
+
+
+# files smaller than this are parsed serially: starting the pool and concatenating the shards costs more than
+# parsing them (eng.train, 3.3MB, is parsed serially in about a second)
+MIN_PARALLEL_READ_BYTES = 32 * 1024 * 1024
+
+
+def parallel_read(file: str, num_workers: int) -> bool:
+    """
+    :return: whether file is large enough, and num_workers within the number of CPUs, for a parallel read to be
+    worth it
+    """
+    return 1 < num_workers <= (os.cpu_count() or 1) and os.path.getsize(file) >= MIN_PARALLEL_READ_BYTES
+
+
+def read_store(file: str, num_workers=1) -> 'CorpusStore':
+    """
+    Reads a dataset as read_data does, into a CorpusStore: in parallel, the concatenated shards are returned as they
+    are, without building their sentences
+    :param num_workers: number of processes parsing the file, see read_data
+    :return: CorpusStore
+    """
+    if os.path.isdir(file):
+        return CorpusStore.load(file)
+    if not parallel_read(file, num_workers):
+        return CorpusStore.from_sentences(iter_data(file))
+
+    boundaries = shard_boundaries(file, num_workers)
+    with multiprocessing.Pool(num_workers) as pool:
+        shards = pool.starmap(_read_shard, [(file, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])])
+    return CorpusStore.concatenate([CorpusStore.from_arrays(arrays) for arrays in shards])
+
+
+def read_data(file: str, num_workers=1) -> List[LabeledSentence]:
+    """
+    Reads a dataset in the CoNLL format from a file, see iter_data, or from a directory written by CorpusStore.save
+    :param file: string filename to read
+    :param num_workers: number of processes parsing the file; it is split into byte ranges at blank lines, parsed in
+    parallel into CorpusStores, which are concatenated in the order of the file and turned back into sentences,
+    identical to the serial reader (with the same interning and sharing of Tokens). The file is read serially if it
+    is smaller than MIN_PARALLEL_READ_BYTES or if num_workers is more than the number of CPUs
+    :return: list[LabeledSentence]
+    """
+    if os.path.isdir(file):
+        return CorpusStore.load(file).to_sentences()
+    if not parallel_read(file, num_workers):
+        return list(iter_data(file))
+    return read_store(file, num_workers).to_sentences()
+
+
+def encode_strings(strings: List[str]):
+    """
+    packs strings without newlines (tokens, pos tags) into a flat uint8 array of their utf-8 bytes
+    """
+    return np.frombuffer('\n'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def decode_strings(array: np.ndarray):
+    """
+    inverse of encode_strings
+    """
+    if len(array) == 0:
+        return []
+    return bytes(array).decode('utf-8').split('\n')
+
+
+class CorpusStore(object):
+    """
+    Columnar binary form of a CoNLL dataset: every column of the tokens is an int32 array of ids into an Indexer, and
+    the sentences are delimited by offsets. Saved as one .npy file per array, so that load memory maps them and the
+    models can count and featurize over the ids without parsing text or building Token objects.
+
+    Attributes:
+        word_ids, pos_ids, chunk_ids, tag_ids: [num_tokens] int32 ids of the word, POS, syntactic chunk and BIO tag
+        offsets: [num_sentences + 1] int64, the tokens of sentence i are at offsets[i]:offsets[i+1]
+        word_indexer, pos_indexer, chunk_indexer, tag_indexer: Indexers of the ids, in order of first occurrence
+    """
+    columns = ('word', 'pos', 'chunk', 'tag')
+
+    def __init__(self, ids: List[np.ndarray], offsets: np.ndarray, indexers: List[Indexer]):
+        self.word_ids, self.pos_ids, self.chunk_ids, self.tag_ids = ids
+        self.offsets = offsets
+        self.word_indexer, self.pos_indexer, self.chunk_indexer, self.tag_indexer = indexers
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def num_tokens(self):
+        return int(self.offsets[-1])
+
+    def lengths(self):
+        """
+        :return: [num_sentences] array of the sentence lengths
+        """
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_sentences(cls, sentences: Iterable[LabeledSentence]):
+        indexers = [Indexer() for column in cls.columns]
+        ids = [[] for column in cls.columns]
+        offsets = [0]
+        for sentence in sentences:
+            for token, tag in zip(sentence.tokens, sentence.get_bio_tags()):
+                for column, value in enumerate((token.word, token.pos, token.chunk, tag)):
+                    ids[column].append(indexers[column].add_and_get_index(value))
+            offsets.append(offsets[-1] + len(sentence))
+        return cls([np.array(column_ids, dtype=np.int32) for column_ids in ids], np.array(offsets, dtype=np.int64),
+                   indexers)
+
+    @classmethod
+    def concatenate(cls, stores: List['CorpusStore']):
+        """
+        :return: one store of the sentences of all the stores, in order; the strings are indexed in order of first
+        occurrence, as from_sentences would index them
+        """
+        indexers = [Indexer() for column in cls.columns]
+        ids = [[] for column in cls.columns]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for store in stores:
+            for column, indexer, column_ids in zip(cls.columns, indexers, ids):
+                new_ids = np.array([indexer.add_and_get_index(value) for value in store.strings(column)], dtype=np.int32)
+                column_ids.append(new_ids[np.asarray(getattr(store, column + '_ids'))])
+            offsets.append(offsets[-1][-1] + np.asarray(store.offsets[1:], dtype=np.int64))
+        return cls([np.concatenate(column_ids).astype(np.int32) for column_ids in ids], np.concatenate(offsets),
+                   indexers)
+
+    def to_arrays(self):
+        """
+        :return: dict with the ids and the encoded strings (see encode_strings) of every column, and the offsets
+        """
+        arrays = {'offsets': self.offsets}
+        for column in self.columns:
+            arrays[column + '_ids'] = getattr(self, column + '_ids')
+            arrays[column + '_vocab'] = encode_strings(self.strings(column))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        inverse of to_arrays
+        :param arrays: mapping from the names returned by to_arrays to the arrays, e.g. memory mapped files
+        """
+        indexers = []
+        for column in cls.columns:
+            indexer = Indexer()
+            for value in decode_strings(arrays[column + '_vocab']):
+                indexer.add_and_get_index(value)
+            indexers.append(indexer)
+        return cls([arrays[column + '_ids'] for column in cls.columns], arrays['offsets'], indexers)
+
+    def save(self, path: str):
+        """
+        Writes the store to the directory path, one .npy file per array of to_arrays
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, array in self.to_arrays().items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a store written by save, memory mapping the id arrays read only
+        """
+        arrays = {'offsets': np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')}
+        for column in cls.columns:
+            arrays[column + '_ids'] = np.load(os.path.join(path, column + '_ids.npy'), mmap_mode='r')
+            arrays[column + '_vocab'] = np.load(os.path.join(path, column + '_vocab.npy'))
+        return cls.from_arrays(arrays)
+
+    def indexers(self):
+        return [self.word_indexer, self.pos_indexer, self.chunk_indexer, self.tag_indexer]
+
+    def strings(self, column: str):
+        """
+        :return: list of the strings of a column's indexer, so that strings(column)[id] is the string of an id
+        """
+        indexer = getattr(self, column + '_indexer')
+        return [indexer.get_object(i) for i in range(0, len(indexer))]
+
+    def to_sentences(self) -> List[LabeledSentence]:
+        """
+        :return: the LabeledSentences of the store, as read_data returns them for the original CoNLL file: the strings
+        are interned and the Tokens with the same word, POS and chunk are shared. The tags of a store are the BIO tags
+        of the chunks of its sentences (see from_sentences), so the chunks are extracted for all the sentences at
+        once and the tags are used as they are
+        """
+        words, pos_tags, chunks, tags = ([sys.intern(value) for value in self.strings(column)] for column in self.columns)
+        word_ids, pos_ids, chunk_ids, tag_ids = (np.asarray(getattr(self, column + '_ids'), dtype=np.int64)
+                                                 for column in self.columns)
+        offsets = np.asarray(self.offsets)
+
+        #one shared Token per distinct (word, POS, chunk)
+        keys = (word_ids * len(pos_tags) + pos_ids) * len(chunks) + chunk_ids
+        distinct, token_ids = np.unique(keys, return_inverse=True)
+        shared_tokens = [Token(words[key // (len(pos_tags) * len(chunks))], pos_tags[key // len(chunks) % len(pos_tags)],
+                               chunks[key % len(chunks)]) for key in distinct.tolist()]
+        all_tokens = [shared_tokens[i] for i in token_ids.tolist()]
+        all_tags = [tags[i] for i in tag_ids.tolist()]
+
+        scheme = BioTagScheme(tags)
+        labels = [sys.intern(label) for label in scheme.labels]
+        starts, ends, label_ids = scheme.chunk_arrays(tag_ids, offsets)
+        chunk_sentences = np.searchsorted(offsets, starts, side='right') - 1
+        sentence_chunks = [[] for sentence in range(len(self))]
+        for sentence, start, end, label_id in zip(chunk_sentences.tolist(), (starts - offsets[chunk_sentences]).tolist(),
+                                                  (ends - offsets[chunk_sentences]).tolist(), label_ids.tolist()):
+            sentence_chunks[sentence].append(Chunk(start, end, labels[label_id]))
+
+        offsets = offsets.tolist()
+        return [LabeledSentence(all_tokens[start:end], sentence_chunks[sentence], all_tags[start:end])
+                for sentence, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]))]
 
 
 def print_evaluation(gold_sentences: List[LabeledSentence], guess_sentences: List[LabeledSentence]):
@@ -231,14 +562,82 @@ def print_evaluation(gold_sentences: List[LabeledSentence], guess_sentences: Lis
           ", recall: %i/%i" % (correct, num_gold) + " = " + "{0:.2f}".format(rec * 100))
 
 
+def chunk_counts(gold_tag_ids: np.ndarray, guess_tag_ids: np.ndarray, offsets: np.ndarray, scheme: BioTagScheme):
+    """
+    Counts of labeled chunk matches between gold and guessed tag ids of the same corpus, per label of scheme
+    :return: correct, num_pred, num_gold: [num_labels] arrays
+    """
+    gold_starts, gold_ends, gold_labels = scheme.chunk_arrays(gold_tag_ids, offsets)
+    guess_starts, guess_ends, guess_labels = scheme.chunk_arrays(guess_tag_ids, offsets)
+    # chunks never share a start, so a guessed chunk is correct if the gold chunk at its start has the same end and label
+    match = np.minimum(np.searchsorted(gold_starts, guess_starts), max(len(gold_starts) - 1, 0))
+    correct = np.zeros(len(guess_starts), dtype=bool)
+    if len(gold_starts) > 0:
+        correct = (gold_starts[match] == guess_starts) & (gold_ends[match] == guess_ends) & (gold_labels[match] == guess_labels)
+    num_labels = len(scheme.labels)
+    return (np.bincount(guess_labels[correct], minlength=num_labels), np.bincount(guess_labels, minlength=num_labels),
+            np.bincount(gold_labels, minlength=num_labels))
+
+
+def tag_id_arrays(sentences: List[LabeledSentence], tag_indexer: Indexer):
+    """
+    :param tag_indexer: Indexer of the tags, extended with the tags it does not contain yet
+    :return: [num_tokens] tag ids of the bio tags of the sentences and the [num_sentences + 1] offsets of the sentences
+    """
+    tag_ids = [tag_indexer.add_and_get_index(tag) for sentence in sentences for tag in sentence.get_bio_tags()]
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    np.cumsum([len(sentence) for sentence in sentences], out=offsets[1:])
+    return np.array(tag_ids, dtype=np.int64), offsets
+
+
+def print_evaluation_arrays(gold_tag_ids: np.ndarray, guess_tag_ids: np.ndarray, offsets: np.ndarray,
+                            scheme: BioTagScheme):
+    """
+    Same labeled F1, precision and recall as print_evaluation, computed over the tag ids of a whole corpus at once,
+    followed by their breakdown per label
+    :param offsets: [num_sentences + 1] offsets of the sentences, the same for gold and guess
+    """
+    correct, num_pred, num_gold = chunk_counts(gold_tag_ids, guess_tag_ids, offsets, scheme)
+    for label, label_correct, label_pred, label_gold in [(None, correct.sum(), num_pred.sum(), num_gold.sum())] + \
+            list(zip(scheme.labels, correct, num_pred, num_gold)):
+        prec = label_correct/float(label_pred) if label_pred > 0 else 0
+        rec = label_correct/float(label_gold) if label_gold > 0 else 0
+        f1 = 2 * prec * rec / (prec + rec) if prec != 0 or rec != 0 else 0
+        print(("" if label is None else "%s " % label) + "Labeled F1: " + "{0:.2f}".format(f1 * 100) +\
+              ", precision: %i/%i" % (label_correct, label_pred) + " = " + "{0:.2f}".format(prec * 100) + \
+              ", recall: %i/%i" % (label_correct, label_gold) + " = " + "{0:.2f}".format(rec * 100))
+
+
+def print_evaluation_by_type(gold_sentences: List[LabeledSentence], guess_sentences: List[LabeledSentence]):
+    """
+    print_evaluation of the sentences with the breakdown per entity type, see print_evaluation_arrays
+    """
+    tag_indexer = Indexer()
+    gold_tag_ids, offsets = tag_id_arrays(gold_sentences, tag_indexer)
+    guess_tag_ids, guess_offsets = tag_id_arrays(guess_sentences, tag_indexer)
+    if not np.array_equal(offsets, guess_offsets):
+        raise Exception("Mismatched gold/guess sentence lengths")
+    print_evaluation_arrays(gold_tag_ids, guess_tag_ids, offsets, BioTagScheme.from_indexer(tag_indexer))
+
+
 # Writes labeled_sentences to outfile in the CoNLL format
 def print_output(labeled_sentences, outfile):
-    f = open(outfile, 'w')
-    for sentence in labeled_sentences:
-        bio_tags = sentence.get_bio_tags()
-        for i in range(0, len(sentence)):
-            tok = sentence.tokens[i]
-            f.write(tok.word + " " + tok.pos + " " + tok.chunk + " " + bio_tags[i] + "\n")
-        f.write("\n")
+    with open(outfile, 'w') as f:
+        for sentence in labeled_sentences:
+            bio_tags = sentence.get_bio_tags()
+            for i in range(0, len(sentence)):
+                tok = sentence.tokens[i]
+                f.write(tok.word + " " + tok.pos + " " + tok.chunk + " " + bio_tags[i] + "\n")
+            f.write("\n")
     print("Wrote predictions on %i labeled sentences to %s" % (len(labeled_sentences), outfile))
-    f.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='nerdata.py')
+    parser.add_argument('input_path', type=str, help='CoNLL file to convert')
+    parser.add_argument('output_path', type=str, help='directory to write the CorpusStore to')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of processes parsing the CoNLL file')
+    args = parser.parse_args()
+    store = read_store(args.input_path, args.num_workers)
+    store.save(args.output_path)
+    print("Wrote %i sentences, %i tokens to %s" % (len(store), store.num_tokens(), args.output_path))
@@ -6,6 +6,23 @@ import numpy as np
 from typing import List
 
 
+def sparse_gradient_arrays(gradient):
+    """
+    :param gradient: Counter mapping feature indices to gradient values, or a pair (indices, values) of numpy arrays
+    in which an index may appear several times
+    :return: (indices, values) numpy arrays with unique indices, the values of duplicate indices being summed
+    """
+    if isinstance(gradient, dict):
+        indices = np.fromiter(gradient.keys(), dtype=np.int64, count=len(gradient))
+        values = np.fromiter(gradient.values(), dtype=float, count=len(gradient))
+        return indices, values
+    indices, values = gradient
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    values = np.asarray(values, dtype=float).ravel()
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    return unique_indices, np.bincount(inverse, weights=values, minlength=len(unique_indices))
+
+
 class Optimizer(ABC):
     """
     Optimizer that aims to *maximize* a given function.
@@ -24,7 +41,10 @@ class Optimizer(ABC):
         return score
 
     @abstractmethod
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
+        """
+        :param gradient: Counter, or (indices, values) numpy arrays (see sparse_gradient_arrays)
+        """
         pass
 
     @abstractmethod
@@ -50,16 +70,17 @@ class SGDOptimizer(Optimizer):
         self.weights = init_weights
         self.alpha = alpha
 
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         """
         Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
         hyperparameters constant as the batch size is varied
-        :param gradient: Counter containing the gradient values (i.e., sparse representation of the gradient)
+        :param gradient: Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
         :param batch_size: how many examples the gradient was computed on
         :return: nothing, modifies weights in-place
         """
-        for i in gradient.keys():
-            self.weights[i] = self.weights[i] + self.alpha * gradient[i]
+        indices, values = sparse_gradient_arrays(gradient)
+        self.weights[indices] += self.alpha * values
 
     def access(self, i: int):
         """
@@ -98,36 +119,68 @@ class L1RegularizedAdagradTrainer(Optimizer):
         self.use_regularization = use_regularization
         self.approximate = approximate
         self.curr_iter = 0
-        self.last_iter_touched = [0 for i in range(0, self.weights.shape[0])]
+        self.last_iter_touched = np.zeros(self.weights.shape[0], dtype=np.int64)
         self.diag_Gt = np.zeros_like(self.weights, dtype=float)
 
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         """
         Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
         hyperparameters constant as the batch size is varied
-        :param gradient Counter containing the gradient values (i.e., sparse representation of the gradient)
+        :param gradient Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
         :param batch_size: how many examples the gradient was computed on
         :return: nothing, modifies weights in-place
         """
         batch_size_multiplier = 1.0 / batch_size
         self.curr_iter += 1
-        for i in gradient.keys():
-            xti = self.weights[i]
-            # N.B. We negate the gradient here because the Adagrad formulas are all for minimizing
-            # and we're trying to maximize, so think of it as minimizing the negative of the objective
-            # which has the opposite gradient
-            # See section 5.1 in http://www.jmlr.org/papers/volume12/duchi11a/duchi11a.pdf for more details
-            # eta is the step size, lambda is the regularization
-            gti = -gradient[i] * batch_size_multiplier
-            old_eta_over_Htii = self.eta / (1 + np.sqrt(self.diag_Gt[i]))
-            self.diag_Gt[i] += gti * gti
-            Htii = 1 + np.sqrt(self.diag_Gt[i])
-            eta_over_Htii = self.eta / Htii
-            new_xti = xti - eta_over_Htii * gti
-            # Apply the regularizer for every iteration since touched
-            iters_since_touched = self.curr_iter - self.last_iter_touched[i]
-            self.last_iter_touched[i] = self.curr_iter
-            self.weights[i] = np.sign(new_xti) * max(0, np.abs(new_xti) - self.lamb * eta_over_Htii - (iters_since_touched - 1) * self.lamb * old_eta_over_Htii)
+        i, values = sparse_gradient_arrays(gradient)
+        xti = self.weights[i]
+        # N.B. We negate the gradient here because the Adagrad formulas are all for minimizing
+        # and we're trying to maximize, so think of it as minimizing the negative of the objective
+        # which has the opposite gradient
+        # See section 5.1 in http://www.jmlr.org/papers/volume12/duchi11a/duchi11a.pdf for more details
+        # eta is the step size, lambda is the regularization
+        gti = -values * batch_size_multiplier
+        old_eta_over_Htii = self.eta / (1 + np.sqrt(self.diag_Gt[i]))
+        self.diag_Gt[i] += gti * gti
+        Htii = 1 + np.sqrt(self.diag_Gt[i])
+        eta_over_Htii = self.eta / Htii
+        new_xti = xti - eta_over_Htii * gti
+        # Apply the regularizer for every iteration since touched
+        iters_since_touched = self.curr_iter - self.last_iter_touched[i]
+        self.last_iter_touched[i] = self.curr_iter
+        self.weights[i] = np.sign(new_xti) * np.maximum(0, np.abs(new_xti) - self.lamb * eta_over_Htii - (iters_since_touched - 1) * self.lamb * old_eta_over_Htii)
+
+    def score(self, feats: List[int]):
+        """
+        :param feats: List[int] feature vector indices (i.e., sparse representation of a feature vector)
+        :return: floating-point score, after catching up the regularization of all the features at once
+        """
+        return float(np.sum(self.access_batch(feats)))
+
+    def access_batch(self, indices):
+        """
+        Vectorized access: applies the pending regularization to all the given weights at once (unless approximate),
+        with the same result as calling access on each of them
+        :param indices: numpy array (or list) of weight indices, possibly with duplicates
+        :return: numpy array of the values of those weights
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if not self.approximate:
+            self.catch_up(np.unique(indices[self.last_iter_touched[indices] != self.curr_iter]))
+        return self.weights[indices]
+
+    def catch_up(self, stale: np.ndarray):
+        """
+        Applies the regularization skipped since the last touch to the given weights
+        :param stale: numpy array of unique indices of weights not touched at the current iteration
+        """
+        xti = self.weights[stale]
+        Htii = 1 + np.sqrt(self.diag_Gt[stale])
+        eta_over_Htii = self.eta / Htii
+        iters_since_touched = self.curr_iter - self.last_iter_touched[stale]
+        self.last_iter_touched[stale] = self.curr_iter
+        self.weights[stale] = np.sign(xti) * np.maximum(0, np.abs(xti) - iters_since_touched * self.lamb * self.eta * eta_over_Htii)
 
     def access(self, i: int):
         """
@@ -145,11 +198,11 @@ class L1RegularizedAdagradTrainer(Optimizer):
 
     def get_final_weights(self):
         """
-        :return: a numpy array containing the final weight vector values -- manually calls access to force each weight to
-        have an up-to-date value.
+        :return: a numpy array containing the final weight vector values -- catches up every stale weight in one
+        vectorized update to force each weight to have an up-to-date value.
         """
-        for i in range(0, self.weights.shape[0]):
-            self.access(i)
+        if not self.approximate:
+            self.catch_up(np.nonzero(self.last_iter_touched != self.curr_iter)[0])
         return self.weights
 
 
@@ -163,15 +216,74 @@ class UnregularizedAdagradTrainer(Optimizer):
         self.eta = eta
         self.diag_Gt = np.zeros_like(self.weights, dtype=float)
 
-    def apply_gradient_update(self, gradient: Counter, batch_size: int):
+    def apply_gradient_update(self, gradient, batch_size: int):
         batch_size_multiplier = 1.0 / batch_size
-        for i in gradient.keys():
-            xti = self.weights[i]
-            gti = -gradient[i] * batch_size_multiplier
-            self.diag_Gt[i] += gti * gti
-            Htii = 1 + np.sqrt(self.diag_Gt[i])
-            eta_over_Htii = self.eta / Htii
-            self.weights[i] = xti - eta_over_Htii * gti
+        i, values = sparse_gradient_arrays(gradient)
+        xti = self.weights[i]
+        gti = -values * batch_size_multiplier
+        self.diag_Gt[i] += gti * gti
+        Htii = 1 + np.sqrt(self.diag_Gt[i])
+        eta_over_Htii = self.eta / Htii
+        self.weights[i] = xti - eta_over_Htii * gti
+
+    def access(self, i: int):
+        return self.weights[i]
+
+    def get_final_weights(self):
+        return self.weights
+
+
+class FTRLProximalOptimizer(Optimizer):
+    """
+    FTRL-Proximal with per-coordinate learning rates and L1/L2 regularization. Unlike the lazily regularized Adagrad,
+    the weights are obtained in closed form from the accumulated gradients, and every weight whose accumulated gradient
+    is within l1 of zero is exactly 0, so the final weight vector of a huge indicator feature space is truly sparse.
+    Same interface as the Adagrad trainers.
+    See algorithm 1 of https://research.google.com/pubs/archive/41159.pdf for more details
+    """
+    def __init__(self, init_weights, alpha=0.1, beta=1.0, l1=1.0, l2=1.0):
+        """
+        :param init_weights: a numpy array of the correct dimension, usually initialized to 0. It is updated in place.
+        :param alpha: float step size of the per-coordinate learning rate alpha / (beta + sqrt(sum of squared gradients))
+        :param beta: float smoothing of the learning rate, 1.0 is usually fine
+        :param l1: float L1 regularization strength, larger values give sparser weights
+        :param l2: float L2 regularization strength
+        """
+        self.weights = init_weights
+        self.alpha = alpha
+        self.beta = beta
+        self.l1 = l1
+        self.l2 = l2
+        self.n = np.zeros_like(self.weights, dtype=float)
+        # accumulated gradients, set so that the closed form below gives back the initial weights
+        self.z = -self.weights * (self.beta / self.alpha + self.l2) - np.sign(self.weights) * self.l1
+
+    def apply_gradient_update(self, gradient, batch_size: int):
+        """
+        Take a sparse representation of the gradient and make an update, normalizing by the batch size to keep
+        hyperparameters constant as the batch size is varied
+        :param gradient Counter containing the gradient values (i.e., sparse representation of the gradient), or
+        (indices, values) numpy arrays
+        :param batch_size: how many examples the gradient was computed on
+        :return: nothing, modifies weights in-place
+        """
+        i, values = sparse_gradient_arrays(gradient)
+        # N.B. negated as in the Adagrad trainers since FTRL minimizes and we're trying to maximize
+        gti = -values * (1.0 / batch_size)
+        sigma = (np.sqrt(self.n[i] + gti * gti) - np.sqrt(self.n[i])) / self.alpha
+        self.z[i] += gti - sigma * self.weights[i]
+        self.n[i] += gti * gti
+        self.weights[i] = self.closed_form_weights(i)
+
+    def closed_form_weights(self, i):
+        """
+        :param i: numpy array of weight indices
+        :return: the weights minimizing the regularized objective given the accumulated gradients z and n
+        """
+        z = self.z[i]
+        weights = -(z - np.sign(z) * self.l1) / ((self.beta + np.sqrt(self.n[i])) / self.alpha + self.l2)
+        weights[np.abs(z) <= self.l1] = 0.0
+        return weights
 
     def access(self, i: int):
         return self.weights[i]